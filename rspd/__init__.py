@@ -0,0 +1,39 @@
+'''RoofTop Solar Panel Detection using Deep Learning (RSPD-1222)
+
+The functions below are imported from their submodule on first use, so importing the
+package (and starting the command line) does not load TensorFlow, Keras or scikit-learn.
+'''
+import importlib
+
+_EXPORTS = {
+    'load_data': 'data',
+    'list_tiles': 'data',
+    'decode_tiles': 'data',
+    'tile_ids': 'data',
+    'make_dataset': 'data',
+    'normalise_batch': 'data',
+    'build_model': 'model',
+    'to_fully_convolutional': 'model',
+    'build_backbone': 'model',
+    'build_head': 'model',
+    'attach_head': 'model',
+    'embed_tiles': 'embeddings',
+    'train_model': 'cv',
+    'cv_performance_assessment': 'cv',
+    'evaluate_scores': 'evaluate',
+    'threshold_sweep': 'evaluate',
+    'error_buckets': 'evaluate',
+    'predict_tiles': 'predict',
+    'PredictionCache': 'predict',
+    'load_scene': 'inference',
+    'predict_scene': 'inference',
+    'quantize_model': 'quantize',
+    'TFLiteModel': 'quantize',
+}
+
+__all__ = sorted(_EXPORTS)
+
+def __getattr__(name):
+    if name in _EXPORTS:
+        return getattr(importlib.import_module('.' + _EXPORTS[name], __name__), name)
+    raise AttributeError('module {!r} has no attribute {!r}'.format(__name__, name))
@@ -0,0 +1,5 @@
+from .cli import main
+
+# guarded, the cross-validation workers import this module again when they start
+if __name__ == '__main__':
+    main()
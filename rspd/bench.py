@@ -0,0 +1,341 @@
+'''Benchmark suite of the loading, training, prediction and cross validation hot paths
+
+Runs on synthetic 101x101x3 tiles written to a scratch directory, so it needs neither
+the dataset nor the network. The results are saved as JSON and compared against a
+stored baseline to flag regressions.
+'''
+import os
+import sys
+import json
+import time
+import platform
+
+import numpy as np
+
+from .data import decode_tiles
+from .data import list_tiles
+from .data import load_data
+from .data import peak_rss_mb
+
+# metric name: (unit, higher is better)
+METRICS = {
+    'decode_tiles_per_sec': ('tiles/sec', True),
+    'cache_cold_tiles_per_sec': ('tiles/sec', True),
+    'cache_warm_tiles_per_sec': ('tiles/sec', True),
+    'input_tiles_per_sec': ('tiles/sec', True),
+    'augment_headroom': ('x', True),
+    'train_epoch_sec': ('sec', False),
+    'predict_tiles_per_sec': ('tiles/sec', True),
+    'cv_wall_clock_sec': ('sec', False),
+    'evaluation_sec': ('sec', False),                           # evaluate_scores only, the legacy code is a reference
+    'peak_rss_mb': ('MB', False),
+    'peak_rss_workers_mb': ('MB', False),
+}
+
+
+def make_synthetic_tiles(directory, num_tiles=600, tile_shape=(101, 101, 3), random_seed=1):
+    '''
+    Write a synthetic dataset laid out like the original one
+
+    Input:
+        directory: dataset directory, the tiles go to <directory>/training
+        num_tiles: number of tiles
+        tile_shape: shape of one tile
+        random_seed: seed of the tiles and labels
+
+    Every tile is noise, about a third of them labelled 1 with a bright rectangle (the
+    "panel") drawn on top, so the model has something to learn.
+
+    returns: The image directory and the labels csv file
+    '''
+    from PIL import Image
+
+    dir_images = os.path.join(directory, 'training')
+    dir_labels = os.path.join(directory, 'labels_training.csv')
+    os.makedirs(dir_images, exist_ok=True)
+
+    rng = np.random.default_rng(random_seed)
+    labels = (rng.random(num_tiles) < 1/3).astype(int)          # Roughly the class balance of the real data
+    height, width = tile_shape[:2]
+    with open(dir_labels, 'w') as f:
+        f.write('id,label\n')
+        for identifier, label in enumerate(labels):
+            tile = rng.integers(0, 160, size=tile_shape, dtype=np.uint8)
+            if label:
+                top, left = rng.integers(0, height - 20), rng.integers(0, width - 30)
+                tile[top:top + 20, left:left + 30] = 230
+            Image.fromarray(tile).save(os.path.join(dir_images, '{}.tif'.format(identifier)))
+            f.write('{},{}\n'.format(identifier, label))
+    return dir_images, dir_labels
+
+def _best_rate(fn, num_items, repeats):
+    '''
+    returns: Highest items/sec over the repeated calls of fn, the least noisy estimate
+    '''
+    best = 0.0
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn()
+        best = max(best, num_items / (time.perf_counter() - start))
+    return best
+
+def bench_loading(dir_images, dir_labels, cache_dir, num_workers=None, repeats=3):
+    '''
+    returns: tiles/sec of decoding the tiles, and of load_data on the cold and warm cache paths
+    '''
+    fnames, _ = list_tiles(dir_images, dir_labels)
+    results = {'decode_tiles_per_sec': _best_rate(lambda: decode_tiles(fnames, num_workers=num_workers),
+                                                  len(fnames), repeats)}
+    results['cache_cold_tiles_per_sec'] = _best_rate(
+        lambda: load_data(dir_images, dir_labels, cache_dir=cache_dir, num_workers=num_workers, refresh=True),
+        len(fnames), repeats)
+    results['cache_warm_tiles_per_sec'] = _best_rate(
+        lambda: np.asarray(load_data(dir_images, dir_labels, cache_dir=cache_dir)[0]).sum(),   # Touch every page
+        len(fnames), repeats)
+    return results
+
+def bench_input_pipeline(X, y, batch_size=32, repeats=3, random_seed=1):
+    '''
+    returns: tiles/sec of the training input pipeline alone, without and with augmentation
+    '''
+    from .data import make_dataset
+    indices = np.arange(len(X))
+    rates = {}
+    for name, augment in (('plain', False), ('augmented', True)):
+        dataset = make_dataset(X, y, indices, batch_size=batch_size, shuffle=True, random_seed=random_seed,
+                               augment=augment)
+        for _ in dataset.take(1):                               # Trace the pipeline functions
+            pass
+        rates[name] = _best_rate(lambda: [None for _ in dataset], len(X), repeats)
+    return rates
+
+def bench_training(X, y, build_fn, epochs=3, random_seed=1):
+    '''
+    Train a model with train_model and time its epochs
+
+    returns: Median seconds per epoch, not counting the first one (tracing and warm up),
+             and the trained model
+    '''
+    import keras
+    from .cv import train_model
+
+    class EpochTimer(keras.callbacks.Callback):
+        def on_epoch_begin(self, epoch, logs=None):
+            self.start = time.perf_counter()
+
+        def on_epoch_end(self, epoch, logs=None):
+            durations.append(time.perf_counter() - self.start)
+
+    durations = []
+    clf = train_model(X, y, build_fn, random_seed=random_seed, epochs=epochs, callbacks=[EpochTimer()])
+    return float(np.median(durations[1:] or durations)), clf
+
+def bench_predict(model, X, batch_sizes=(1, 32, 256), repeats=3):
+    '''
+    returns: tiles/sec of model.predict over the input pipeline, for every batch size
+    '''
+    from .data import make_dataset
+    indices = np.arange(len(X))
+    rates = {}
+    for batch_size in batch_sizes:
+        dataset = make_dataset(X, None, indices, batch_size=batch_size)
+        model.predict(dataset.take(1), verbose=0)               # Trace the predict function for this batch size
+        rates[str(batch_size)] = _best_rate(lambda: model.predict(dataset, verbose=0), len(X), repeats)
+    return rates
+
+def bench_cv(X, y, build_fn, num_folds=3, n_jobs=None, epochs=3, random_seed=1):
+    '''
+    returns: Wall clock seconds of cv_performance_assessment, and the largest peak resident
+             memory of its worker processes in MB (None when the folds ran in this process)
+    '''
+    from .cv import cv_performance_assessment
+    start = time.perf_counter()
+    _, stats = cv_performance_assessment(X, y, num_folds, build_fn, random_seed=random_seed, n_jobs=n_jobs,
+                                         epochs=epochs, return_stats=True)
+    return time.perf_counter() - start, stats['worker_peak_rss_mb']
+
+def _legacy_evaluation(dir_labels, scores):
+    '''
+    The evaluation of the notebook before rspd.evaluate, on object scores as returned
+    by cv_performance_assessment at the time
+    '''
+    import pandas as pd
+    from sklearn.metrics import roc_auc_score
+    from sklearn.metrics import confusion_matrix
+    df = pd.read_csv(dir_labels)
+    df["predicted_class"] = [1 if pred >= 0.5 else 0 for pred in scores]
+    fn = np.array(df[(df['label'] == 1) & (df['predicted_class'] == 0)]['id'])
+    fp = np.array(df[(df['label'] == 0) & (df['predicted_class'] == 1)]['id'])
+    tp = np.array(df[(df['label'] == 1) & (df['predicted_class'] == 1)]['id'])
+    tn = np.array(df[(df['label'] == 0) & (df['predicted_class'] == 0)]['id'])
+    auc = roc_auc_score(df['label'], scores)
+    y_pred = [1 if pred >= 0.5 else 0 for pred in scores]
+    return auc, confusion_matrix(df['label'], y_pred), (tn, fp, fn, tp)
+
+def bench_evaluation(workdir, num_predictions=10_000_000, random_seed=1):
+    '''
+    Time the evaluation of num_predictions synthetic scores, the legacy notebook code
+    (reading the labels csv included) against evaluate_scores
+
+    returns: Seconds of both, and checks they agree
+    '''
+    from .evaluate import evaluate_scores
+    rng = np.random.default_rng(random_seed)
+    y = (rng.random(num_predictions) < 1/3).astype(np.int8)
+    scores = np.clip(rng.normal(0.3 + 0.4 * y, 0.2), 0, 1).astype(np.float32)
+    dir_labels = os.path.join(workdir, 'labels_evaluation.csv')
+    np.savetxt(dir_labels, np.c_[np.arange(num_predictions), y], fmt='%d', delimiter=',',
+               header='id,label', comments='')
+    object_scores = np.empty(num_predictions, dtype='object')
+    object_scores[:] = scores.astype(np.float64)
+
+    start = time.perf_counter()
+    auc, matrix, buckets = _legacy_evaluation(dir_labels, object_scores)
+    legacy = time.perf_counter() - start
+    del object_scores
+
+    start = time.perf_counter()
+    evaluation = evaluate_scores(y, scores)
+    vectorised = time.perf_counter() - start
+
+    assert matrix.tolist() == evaluation['confusion_matrix']
+    assert abs(auc - evaluation['auc']) < 1e-6
+    assert all(np.array_equal(ids, evaluation['buckets'][name]) for name, ids in zip(('tn', 'fp', 'fn', 'tp'), buckets))
+    return {'legacy': legacy, 'vectorised': vectorised}
+
+def _environment():
+    '''
+    returns: Description of the machine and library versions, to tell apart results
+             that are not comparable
+    '''
+    import tensorflow as tf
+    return {'python': platform.python_version(),
+            'numpy': np.__version__,
+            'tensorflow': tf.__version__,
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count()}
+
+def run_benchmarks(workdir, num_tiles=600, epochs=3, batch_sizes=(1, 32, 256), num_folds=3, n_jobs=None,
+                   num_workers=None, repeats=3, num_predictions=10_000_000, skip=(), random_seed=1):
+    '''
+    Run the whole benchmark suite
+
+    Input:
+        workdir: scratch directory of the synthetic tiles and their cache
+        num_tiles: number of synthetic tiles
+        epochs: number of training epochs, for the training and cross validation benchmarks
+        batch_sizes: batch sizes of the prediction benchmark
+        num_folds: number of folds of the cross validation benchmark
+        n_jobs: number of folds run at the same time, as in cv_performance_assessment
+        num_workers: number of decoding threads
+        repeats: number of runs of the throughput benchmarks, the best one is kept
+        num_predictions: number of scores of the evaluation benchmark
+        skip: benchmarks not to run, out of 'loading', 'augmentation', 'training', 'predict', 'cv'
+              and 'evaluation'
+        random_seed: seed of the synthetic data and of the training
+
+    returns: Dictionary of the configuration, environment, metrics and reference timings (the
+             legacy evaluation, never compared against a baseline), as saved by save_results
+    '''
+    from .model import build_model
+
+    dir_images, dir_labels = make_synthetic_tiles(workdir, num_tiles, random_seed=random_seed)
+    cache_dir = os.path.join(workdir, 'cache')
+
+    metrics = {}
+    reference = {}                                              # Saved for context, never compared
+    if 'loading' not in skip:
+        metrics.update(bench_loading(dir_images, dir_labels, cache_dir, num_workers=num_workers, repeats=repeats))
+    X, y = load_data(dir_images, dir_labels, cache_dir=cache_dir, num_workers=num_workers)
+
+    if 'augmentation' not in skip:
+        metrics['input_tiles_per_sec'] = bench_input_pipeline(X, y, repeats=repeats, random_seed=random_seed)
+    clf = None
+    if 'training' not in skip:
+        metrics['train_epoch_sec'], clf = bench_training(X, y, build_model, epochs=epochs, random_seed=random_seed)
+    if 'augmentation' not in skip and 'training' not in skip:
+        # how many times faster the augmented input is made than the trainer consumes it, above 1 it never stalls
+        metrics['augment_headroom'] = metrics['input_tiles_per_sec']['augmented'] * metrics['train_epoch_sec'] / len(X)
+    if 'predict' not in skip:
+        metrics['predict_tiles_per_sec'] = bench_predict(clf or build_model(), X, batch_sizes, repeats=repeats)
+    if 'cv' not in skip:
+        metrics['cv_wall_clock_sec'], worker_peak = bench_cv(X, y, build_model, num_folds, n_jobs=n_jobs,
+                                                             epochs=epochs, random_seed=random_seed)
+        if worker_peak is not None:
+            metrics['peak_rss_workers_mb'] = worker_peak
+
+    # the peaks of loading, training and cross validation, before the evaluation of millions of scores dwarfs them
+    metrics['peak_rss_mb'] = peak_rss_mb()
+    if 'evaluation' not in skip:
+        evaluation = bench_evaluation(workdir, num_predictions, random_seed=random_seed)
+        metrics['evaluation_sec'] = evaluation['vectorised']
+        reference['legacy_evaluation_sec'] = evaluation['legacy']
+        reference['evaluation_speedup'] = evaluation['legacy'] / evaluation['vectorised']
+
+    config = {'num_tiles': num_tiles, 'epochs': epochs, 'batch_sizes': list(batch_sizes),
+              'num_folds': num_folds, 'n_jobs': n_jobs, 'num_workers': num_workers,
+              'repeats': repeats, 'num_predictions': num_predictions, 'random_seed': random_seed}
+    return {'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'), 'config': config,
+            'environment': _environment(), 'metrics': metrics, 'reference': reference}
+
+def save_results(results, path):
+    '''
+    Save the results of run_benchmarks as JSON, e.g. as the baseline of later runs
+    '''
+    with open(path, 'w') as f:
+        json.dump(results, f, indent=2)
+
+def load_results(path):
+    '''
+    returns: The results saved by save_results
+    '''
+    with open(path) as f:
+        return json.load(f)
+
+def _flatten(metrics):
+    '''
+    returns: (name, metric, value) of every metric, the per batch size ones named e.g. predict_tiles_per_sec[32]
+    '''
+    for name, value in metrics.items():
+        if isinstance(value, dict):
+            for key, item in value.items():
+                yield '{}[{}]'.format(name, key), name, item
+        else:
+            yield name, name, value
+
+def compare_results(baseline, current, tolerance=0.1):
+    '''
+    Compare two benchmark results metric by metric
+
+    Input:
+        baseline: results of run_benchmarks (or load_results) to compare against
+        current: results of run_benchmarks
+        tolerance: relative change allowed before a slower (or larger) metric is a regression
+
+    returns: List of dictionaries with the name, baseline and current values, the relative
+             change and whether it is a regression, for the metrics present in both results
+    '''
+    baseline_metrics = {name: value for name, _, value in _flatten(baseline['metrics'])}
+    rows = []
+    for name, metric, value in _flatten(current['metrics']):
+        if name not in baseline_metrics or metric not in METRICS:
+            continue
+        base = baseline_metrics[name]
+        change = (value - base) / base if base else 0.0
+        higher_is_better = METRICS[metric][1]
+        rows.append({'metric': name,
+                     'unit': METRICS[metric][0],
+                     'baseline': base,
+                     'current': value,
+                     'change': change,
+                     'regression': (-change if higher_is_better else change) > tolerance})
+    return rows
+
+def print_comparison(rows, out=sys.stdout):
+    '''
+    Print the rows of compare_results as a table, regressions marked with a !
+    '''
+    out.write('{:<34}{:>14}{:>14}{:>10}\n'.format('metric', 'baseline', 'current', 'change'))
+    for row in rows:
+        out.write('{:<34}{:>14.2f}{:>14.2f}{:>+9.1%}{}\n'.format(
+            row['metric'], row['baseline'], row['current'], row['change'], ' !' if row['regression'] else ''))
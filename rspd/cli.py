@@ -0,0 +1,347 @@
+'''Command line interface
+
+    python -m rspd load      decode the training images into the cache
+    python -m rspd train     train the model on all the images and save it
+    python -m rspd cv        cross-validated out-of-fold scores
+    python -m rspd predict   score new tiles (or a whole scene) with a saved model
+    python -m rspd evaluate  AUC, accuracy, confusion matrix and best F1 of saved scores
+    python -m rspd serve     local scoring server, and serve-bench to load test it
+    python -m rspd bench     benchmark suite on synthetic tiles, compared against a baseline
+
+Every command imports only what it needs when it runs, e.g. predicting with a TFLite
+model never loads TensorFlow when a standalone TFLite runtime is installed. The data
+paths default to $RSPD_DATA_DIR (or ./data) laid out like the original dataset.
+'''
+import os
+import sys
+import glob
+import json
+import argparse
+
+import numpy as np
+
+
+def _positive_int(value):
+    '''
+    argparse type of the counts that must be at least 1
+    '''
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError('must be at least 1, got {}'.format(value))
+    return number
+
+def _add_data_args(parser):
+    parser.add_argument('--data-dir', default=os.environ.get('RSPD_DATA_DIR', 'data'),
+                        help='dataset directory holding training/ and labels_training.csv (default: $RSPD_DATA_DIR or data)')
+    parser.add_argument('--images', help='image directory (default: <data-dir>/training)')
+    parser.add_argument('--labels', help='csv file of ids and labels (default: <data-dir>/labels_training.csv)')
+    parser.add_argument('--cache-dir', default=os.environ.get('RSPD_CACHE_DIR'),
+                        help='decoded image cache (default: $RSPD_CACHE_DIR or <data-dir>/cache)')
+    parser.add_argument('--no-cache', action='store_true', help='decode the images without caching them')
+    parser.add_argument('--workers', type=int, default=None, help='number of decoding threads')
+
+def _data_paths(args):
+    '''
+    returns: The image directory, labels csv and cache directory (None with --no-cache) of the arguments
+    '''
+    images = args.images or os.path.join(args.data_dir, 'training')
+    labels = args.labels or os.path.join(args.data_dir, 'labels_training.csv')
+    cache_dir = None if args.no_cache else (args.cache_dir or os.path.join(args.data_dir, 'cache'))
+    return images, labels, cache_dir
+
+def _load(args, timing=False):
+    from .data import load_data
+    images, labels, cache_dir = _data_paths(args)
+    return load_data(images, labels, cache_dir=cache_dir, num_workers=args.workers, timing=timing)
+
+def _add_backbone_args(parser):
+    parser.add_argument('--backbone', help='train a small head on the cached features of this pretrained backbone '
+                                           '(mobilenet_v2, resnet50_v2 or efficientnet_b0) instead of the custom CNN')
+    parser.add_argument('--weights', help='locally stored weights file of the backbone (include_top=False), '
+                                          'required with --backbone')
+    parser.add_argument('--embeddings', help='directory of the embedding stores (default: <data-dir>/embeddings)')
+    parser.add_argument('--refresh-embeddings', action='store_true',
+                        help='compute the backbone features of every tile again (changed tiles always are)')
+
+def _check_backbone_args(args):
+    '''
+    Exit on options that cannot go with --backbone, before any image is loaded
+    '''
+    if args.backbone and not args.weights:
+        sys.exit('--backbone needs --weights, a head on the features of random weights is not a pretrained model')
+    if args.backbone and args.augment:
+        sys.exit('--augment cannot be used with --backbone, the features are computed once per tile')
+
+def _embed(args, X):
+    '''
+    returns: The cached backbone features of the images and the function building a head for them
+    '''
+    from functools import partial
+    from .data import tile_ids
+    from .model import build_head
+    from .embeddings import embed_tiles
+    _, labels, _ = _data_paths(args)
+    features = embed_tiles(X, tile_ids(labels), args.backbone, args.weights,
+                           store_dir=args.embeddings or os.path.join(args.data_dir, 'embeddings'),
+                           refresh=args.refresh_embeddings, timing=True)
+    return features, partial(build_head, features.shape[1])
+
+def cmd_load(args):
+    if args.benchmark:
+        from .data import benchmark_load_data
+        images, labels, cache_dir = _data_paths(args)
+        print(json.dumps(benchmark_load_data(images, labels, cache_dir, num_workers=args.workers), indent=2))
+        return
+    X, y = _load(args, timing=True)
+    print('X shape:', X.shape)
+    print('Distribution of y', np.bincount(y))
+
+def cmd_train(args):
+    from .model import build_model
+    from .cv import train_model
+    _check_backbone_args(args)
+    X, y = _load(args)
+    if args.backbone:
+        from .model import attach_head
+        from .model import build_backbone
+        features, build_fn = _embed(args, X)
+        head = train_model(features, y, build_fn, random_seed=args.seed)
+        clf = attach_head(build_backbone(args.backbone, args.weights, input_shape=X.shape[1:]), head)
+    else:
+        clf = train_model(X, y, build_model, random_seed=args.seed, augment=args.augment)
+    clf.save(args.model)
+    print('Saved the model to', args.model)
+    if args.tflite:
+        from .quantize import quantize_model
+        index = np.sort(np.random.default_rng(args.seed).choice(len(X), min(args.calibration, len(X)), replace=False))
+        quantize_model(clf, X[index], args.tflite)
+        print('Saved the int8 model to', args.tflite)
+
+def cmd_cv(args):
+    from .model import build_model
+    from .cv import cv_performance_assessment
+    from .evaluate import roc_auc
+    from .evaluate import threshold_sweep
+    _check_backbone_args(args)
+    X, y = _load(args)
+    build_fn, n_jobs = build_model, args.jobs
+    if args.backbone:
+        X, build_fn = _embed(args, X)
+        n_jobs = n_jobs or 1                                    # A head trains in seconds, faster than starting workers
+    scores = cv_performance_assessment(X, y, args.folds, build_fn, random_seed=args.seed, n_jobs=n_jobs,
+                                       augment=args.augment)
+    np.save(args.scores, scores)
+    print('Saved the out-of-fold scores to', args.scores)
+    print('AUC: {:.4f}'.format(roc_auc(threshold_sweep(y, scores))))
+
+def _tile_files(paths):
+    '''
+    returns: The .tif files given on the command line, directories are expanded to the .tif files they hold
+    '''
+    fnames = []
+    for path in paths:
+        if os.path.isdir(path):
+            fnames.extend(sorted(glob.glob(os.path.join(path, '*.tif'))))
+        else:
+            fnames.append(path)
+    return fnames
+
+def cmd_predict(args):
+    if args.scene:
+        import keras
+        from .inference import load_scene
+        from .inference import predict_scene
+        model = keras.models.load_model(args.model)
+        scores, heatmap = predict_scene(model, load_scene(args.scene), stride=args.stride,
+                                        batch_size=args.batch_size, timing=True)
+        np.save(args.output or 'heatmap.npy', heatmap)
+        print('Saved the heatmap to', args.output or 'heatmap.npy')
+        return
+
+    from .predict import predict_tiles
+    from .predict import PredictionCache
+    fnames = _tile_files(args.tiles)
+    if not fnames:
+        sys.exit('no .tif tiles found in ' + ' '.join(args.tiles))
+    cache = None
+    if args.cache:
+        cache = PredictionCache(args.cache, keep_models=args.keep_models, max_entries=args.max_entries)
+    scores, stats = predict_tiles(args.model, fnames, cache=cache, batch_size=args.batch_size,
+                                  num_workers=args.workers)
+    if cache is not None:
+        cache.close()
+
+    out = open(args.output, 'w') if args.output else sys.stdout
+    out.write('id,score\n')
+    for fname, score in zip(fnames, scores):
+        out.write('{},{:.6f}\n'.format(os.path.splitext(os.path.basename(fname))[0], score))
+    if args.output:
+        out.close()
+    print(json.dumps(stats), file=sys.stderr)                   # stdout may be the csv
+
+def cmd_evaluate(args):
+    import pandas as pd
+    from .evaluate import evaluate_scores
+    _, labels, _ = _data_paths(args)
+    y = pd.read_csv(labels, usecols=['label']).label.values
+    evaluation = evaluate_scores(y, np.load(args.scores), threshold=args.threshold)
+    if args.sweep:
+        sweep = evaluation['sweep']
+        np.savetxt(args.sweep, np.column_stack(list(sweep.values())), fmt='%.6g', delimiter=',',
+                   header=','.join(sweep), comments='')
+        print('Saved the threshold sweep to', args.sweep)
+    print(json.dumps({key: evaluation[key] for key in ('auc', 'accuracy', 'confusion_matrix', 'best_f1')},
+                     indent=2))
+
+def cmd_serve(args):
+    from .serve import serve
+    serve(args.model, host=args.host, port=args.port, max_batch=args.max_batch,
+          max_latency_ms=args.max_latency_ms, num_threads=args.threads)
+
+def cmd_serve_bench(args):
+    from .serve import benchmark
+    print(json.dumps(benchmark(args.url, concurrency=args.concurrency, num_requests=args.requests,
+                               tiles_per_request=args.tiles_per_request), indent=2))
+
+def cmd_bench(args):
+    import tempfile
+    from .bench import run_benchmarks
+    from .bench import save_results
+    from .bench import load_results
+    from .bench import compare_results
+    from .bench import print_comparison
+    baseline = None
+    if args.baseline:
+        if not args.compare and os.path.exists(args.output) and os.path.samefile(args.output, args.baseline):
+            sys.exit('--output is the --baseline file, the run would overwrite the baseline it is compared against')
+        baseline = load_results(args.baseline)                  # Before anything is saved
+    if args.compare:                                            # Compare two stored results without running anything
+        current = load_results(args.compare)
+    else:
+        with tempfile.TemporaryDirectory(dir=args.workdir) as workdir:
+            current = run_benchmarks(workdir, num_tiles=args.tiles, epochs=args.epochs,
+                                     batch_sizes=args.batch_sizes, num_folds=args.folds, n_jobs=args.jobs,
+                                     num_workers=args.workers, repeats=args.repeats,
+                                     num_predictions=args.predictions, skip=args.skip)
+        save_results(current, args.output)
+        print('Saved the results to', args.output)
+    if baseline is not None:
+        for key in ('config', 'environment'):
+            if baseline[key] != current[key]:
+                print('warning: the {} of the baseline differs, the results may not be comparable'.format(key))
+        rows = compare_results(baseline, current, tolerance=args.tolerance)
+        print_comparison(rows)
+        regressions = [row['metric'] for row in rows if row['regression']]
+        if regressions:
+            sys.exit('regressions beyond {:.0%}: {}'.format(args.tolerance, ', '.join(regressions)))
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog='rspd', description='RoofTop Solar Panel Detection using Deep Learning')
+    parser.add_argument('--trace', help='save the time, throughput and memory of every stage as JSON to this file')
+    parser.add_argument('--chrome-trace', help='save the stages in the Chrome trace format to this file')
+    parser.add_argument('--tf-profile', help='run the TensorFlow profiler into this directory, for per layer costs')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    load = commands.add_parser('load', help='decode the training images into the cache')
+    _add_data_args(load)
+    load.add_argument('--benchmark', action='store_true', help='time the cold and warm loading paths')
+    load.set_defaults(func=cmd_load)
+
+    train = commands.add_parser('train', help='train the model on all the images and save it')
+    _add_data_args(train)
+    train.add_argument('--model', default='rspd_cnn.keras', help='file the trained model is saved to')
+    train.add_argument('--tflite', help='also save an int8 TFLite export of the model to this file')
+    train.add_argument('--calibration', type=int, default=200, help='number of images calibrating the int8 export')
+    train.add_argument('--seed', type=int, default=1)
+    train.add_argument('--augment', action='store_true', help='randomly flip, rotate, jitter and crop the training tiles')
+    _add_backbone_args(train)
+    train.set_defaults(func=cmd_train)
+
+    cv = commands.add_parser('cv', help='cross-validated out-of-fold scores')
+    _add_data_args(cv)
+    cv.add_argument('--folds', type=int, default=3)
+    cv.add_argument('--jobs', type=_positive_int, default=None,
+                    help='folds run at the same time (default: all, one with --backbone)')
+    cv.add_argument('--scores', default='cv_scores.npy', help='file the out-of-fold scores are saved to')
+    cv.add_argument('--seed', type=int, default=1)
+    cv.add_argument('--augment', action='store_true', help='randomly flip, rotate, jitter and crop the training tiles')
+    _add_backbone_args(cv)
+    cv.set_defaults(func=cmd_cv)
+
+    predict = commands.add_parser('predict', help='score tiles (or a whole scene) with a saved model')
+    predict.add_argument('model', help='saved Keras model, or .tflite model from train --tflite')
+    predict.add_argument('tiles', nargs='*', help='.tif tiles, or directories of them')
+    predict.add_argument('--scene', help='score this whole scene instead and save its heatmap (Keras models only)')
+    predict.add_argument('--stride', type=int, default=32, help='window step in pixels for --scene')
+    predict.add_argument('--batch-size', type=int, default=64)
+    predict.add_argument('--workers', type=int, default=None, help='number of decoding threads')
+    predict.add_argument('--output', help='output file (default: csv on stdout, heatmap.npy for --scene)')
+    predict.add_argument('--cache', default=os.environ.get('RSPD_PREDICTION_CACHE'),
+                         help='SQLite prediction cache, only new or changed tiles are scored '
+                              '(default: $RSPD_PREDICTION_CACHE, none if unset)')
+    predict.add_argument('--keep-models', type=int, default=2, help='model versions whose scores the cache keeps')
+    predict.add_argument('--max-entries', type=int, default=None, help='largest number of scores the cache keeps')
+    predict.set_defaults(func=cmd_predict)
+
+    evaluate = commands.add_parser('evaluate', help='AUC, accuracy, confusion matrix and best F1 of saved scores')
+    _add_data_args(evaluate)
+    evaluate.add_argument('--scores', default='cv_scores.npy', help='scores saved by cv, in the order of the labels csv')
+    evaluate.add_argument('--threshold', type=float, default=0.5)
+    evaluate.add_argument('--sweep', help='save the precision/recall/F1 and ROC at every threshold to this csv')
+    evaluate.set_defaults(func=cmd_evaluate)
+
+    serve = commands.add_parser('serve', help='serve a saved model over HTTP with micro-batching')
+    serve.add_argument('model', help='saved Keras model, or .tflite model from train --tflite')
+    serve.add_argument('--host', default='127.0.0.1')
+    serve.add_argument('--port', type=int, default=8500)
+    serve.add_argument('--max-batch', type=int, default=64)
+    serve.add_argument('--max-latency-ms', type=float, default=5.0)
+    serve.add_argument('--threads', type=int, default=None, help='TFLite interpreter threads')
+    serve.set_defaults(func=cmd_serve)
+
+    serve_bench = commands.add_parser('serve-bench', help='load test a running server')
+    serve_bench.add_argument('--url', default='http://127.0.0.1:8500')
+    serve_bench.add_argument('--concurrency', type=int, default=16)
+    serve_bench.add_argument('--requests', type=int, default=2000)
+    serve_bench.add_argument('--tiles-per-request', type=int, default=1)
+    serve_bench.set_defaults(func=cmd_serve_bench)
+
+    bench = commands.add_parser('bench', help='benchmark suite on synthetic tiles, compared against a baseline')
+    bench.add_argument('--output', default='bench.json', help='file the results are saved to')
+    bench.add_argument('--baseline', help='earlier results to compare against, exits with an error on regressions')
+    bench.add_argument('--compare', help='compare these saved results against --baseline instead of running')
+    bench.add_argument('--tolerance', type=float, default=0.1, help='relative slowdown allowed (default: 0.1)')
+    bench.add_argument('--tiles', type=int, default=600, help='number of synthetic tiles')
+    bench.add_argument('--epochs', type=int, default=3)
+    bench.add_argument('--batch-sizes', type=lambda s: [int(b) for b in s.split(',')], default=[1, 32, 256],
+                       help='comma separated batch sizes of the predict benchmark')
+    bench.add_argument('--folds', type=int, default=3)
+    bench.add_argument('--jobs', type=_positive_int, default=None, help='folds run at the same time (default: all)')
+    bench.add_argument('--workers', type=int, default=None, help='number of decoding threads')
+    bench.add_argument('--repeats', type=int, default=3, help='runs of each throughput benchmark, the best is kept')
+    bench.add_argument('--predictions', type=int, default=10_000_000, help='number of scores of the evaluation benchmark')
+    bench.add_argument('--skip', nargs='*', default=[], choices=['loading', 'augmentation', 'training',
+                                                                   'predict', 'cv', 'evaluation'])
+    bench.add_argument('--workdir', help='where the synthetic tiles are written (default: system temp directory)')
+    bench.set_defaults(func=cmd_bench)
+    return parser
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    if not (args.trace or args.chrome_trace or args.tf_profile):
+        args.func(args)
+        return
+    from .trace import tracing
+    with tracing(args.trace, args.chrome_trace, args.tf_profile) as tracer:
+        args.func(args)
+    summary = tracer.summary()
+    for name, stage in summary['stages'].items():
+        print('{:<16}{:>4} x {:>9.3f}s{:>14}  at end {:>7.0f} MB{:>18}'.format(
+            name, stage['count'], stage['mean_sec'],
+            '' if stage['items_per_sec'] is None else '{:.1f}/s'.format(stage['items_per_sec']),
+            stage['rss_mb_at_end'],
+            '' if stage['peak_growth_mb'] is None else 'peak +{:.0f} MB'.format(stage['peak_growth_mb'])),
+            file=sys.stderr)
+    if summary['bottleneck']:
+        print('bottleneck: {} (input pipeline {:.1f}x faster than training)'.format(
+            summary['bottleneck'], summary['input_headroom']), file=sys.stderr)
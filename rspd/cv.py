@@ -0,0 +1,201 @@
+'''Cross validated performance assessment of the CNN model'''
+import os
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import tensorflow as tf
+from sklearn.model_selection import StratifiedKFold
+
+from . import trace
+from .data import make_dataset
+from .data import peak_rss_mb
+
+
+def _init_worker(num_threads):
+    '''
+    Pin the thread budget of a fold worker before TensorFlow starts its runtime,
+    so the workers together never run more threads than there are cores
+    '''
+    os.environ['OMP_NUM_THREADS'] = str(num_threads)
+    tf.config.threading.set_intra_op_parallelism_threads(num_threads)
+    tf.config.threading.set_inter_op_parallelism_threads(1)
+
+def _worker_source(X):
+    '''
+    X: training data passed to cv_performance_assessment
+    returns: What to send to the fold workers - the path of the cache file when X is
+             the whole memmap returned by load_data (so it is reopened instead of pickled), else X
+    '''
+    if isinstance(X, np.memmap) and X.filename is not None:
+        on_disk = np.load(X.filename, mmap_mode='r')
+        if on_disk.shape == X.shape and on_disk.dtype == X.dtype:
+            return X.filename
+    return X
+
+def train_model(X, y, build_fn, indices=None, random_seed=1, num_threads=None, epochs=10, callbacks=None,
+                augment=False, fold=None):
+    '''
+    Train a new classifier
+
+    Input:
+        X: training data as uint8 images, or image file names from list_tiles
+        y: training labels
+        build_fn: function returning a new compiled classifier, e.g. build_model
+        indices: rows used for training, None for all of them
+        random_seed: seed of the shuffling
+        num_threads: thread budget of the input pipeline, None for no limit
+        epochs: number of passes over the training data
+        callbacks: Keras callbacks passed to fit, e.g. to time the epochs
+        augment: randomly flip, rotate, jitter and crop the training images, see augment_batch
+        fold: index of the cross validation fold, recorded with the traced stages; None outside cross validation
+
+    returns: The trained classifier
+    '''
+    indices = np.arange(len(y)) if indices is None else indices
+    trace_args = {} if fold is None else {'fold': fold}
+
+    def training_data():
+        return make_dataset(X, y, indices, batch_size=32, shuffle=True, random_seed=random_seed,
+                            num_threads=num_threads, augment=augment)
+
+    train_data = training_data()
+
+    # give more weight to minority class based on the target class distribution
+    class_weight = {0: 505/1500, 1: 995/1500}
+
+    if trace.active():
+        trace.probe_input(training_data())                      # A separate copy, the shuffling of train_data is untouched
+        callbacks = list(callbacks or []) + [trace.epoch_callback(len(indices), **trace_args)]
+
+    # train a new classifier, so it never starts from the weights of another one
+    clf = build_fn()
+    with trace.stage('fit', items=len(indices) * epochs, epochs=epochs, **trace_args):
+        clf.fit(x=train_data,
+                class_weight=class_weight,
+                epochs=epochs,
+                callbacks=callbacks,
+                verbose=1)
+    return clf
+
+def _run_fold(build_fn, source, y, train_index, val_index, random_seed, num_threads=None, epochs=10,
+              augment=False, fold=None):
+    '''
+    Train a fresh model on one fold and score its validation data
+
+    Input:
+        build_fn: function returning a new compiled model, e.g. build_model
+        source: training data, or the path of the memmapped cache file
+        y: training labels
+        train_index: rows used for training
+        val_index: rows used for validation
+        random_seed: seed of the shuffling
+        num_threads: thread budget of the input pipeline, None for no limit
+        epochs: number of passes over the training data
+        augment: augment the training images of this fold
+        fold: index of the fold, recorded with the traced stages
+
+    returns: The validation rows and their prediction scores
+    '''
+    X = np.load(source, mmap_mode='r') if isinstance(source, str) else source
+
+    with trace.stage('fold', items=len(train_index) + len(val_index), fold=fold):
+        # train a new classifier on the training data of this fold
+        clf = train_model(X, y, build_fn, train_index, random_seed=random_seed, num_threads=num_threads,
+                          epochs=epochs, augment=augment, fold=fold)
+
+        # test the classifier on the validation data for this fold
+        val_data = make_dataset(X, None, val_index, batch_size=32, num_threads=num_threads)
+        with trace.stage('predict', items=len(val_index), fold=fold):
+            y_val_pred_probs = clf.predict(val_data).reshape((-1, ))
+
+    return val_index, y_val_pred_probs
+
+def _run_fold_in_worker(traced, tf_profile_dir, *args):
+    '''
+    _run_fold in a worker process, also returning the peak resident memory of the worker
+    and the events it recorded for the trace of the parent
+
+    Input:
+        traced: record the stages of the fold, as the parent is tracing
+        tf_profile_dir: directory TensorFlow's profiler writes the costs of this fold to, None not to run it
+    '''
+    if not traced:
+        return _run_fold(*args) + (peak_rss_mb(), [])
+    with trace.tracing(tf_profile_dir=tf_profile_dir) as tracer:
+        result = _run_fold(*args)
+    return result + (peak_rss_mb(), tracer.events)
+
+# cross-validate CNN model
+def cv_performance_assessment(X, y, num_folds, build_fn, random_seed=1, n_jobs=None, epochs=10,
+                              augment=False, return_stats=False):
+    '''
+    Cross validated performance assessment
+
+    Input:
+        X: training data as uint8 images (an np.memmap is never copied as a whole),
+           or image file names from list_tiles
+        y: training labels
+        num_folds: number of folds for cross validation
+        build_fn: function returning a new compiled classifier, e.g. build_model
+        random_seed: seed of the fold split and of the shuffling
+        n_jobs: number of folds run at the same time, each in its own process
+                (None runs all the folds at once, 1 runs them one after another here)
+        epochs: number of passes over the training data of each fold
+        augment: augment the training images of every fold, the validation images never are
+        return_stats: also return a dictionary of statistics of the run: 'worker_peak_rss_mb',
+                      the largest peak resident memory of a worker process (None when the
+                      folds ran here)
+
+    Divide the training data into k folds of training and validation data.
+    For each fold a new classifier will be trained on the training data and
+    tested on the validation data. The classifier prediction scores are
+    aggregated and output.
+
+    returns: The out-of-fold prediction scores, and the statistics with return_stats
+    '''
+
+    if n_jobs is not None and n_jobs < 1:
+        raise ValueError('n_jobs must be at least 1, or None to run all the folds at once, got {}'.format(n_jobs))
+
+    prediction_scores = np.empty(y.shape[0], dtype=np.float32)
+
+    # establish the num_folds folds
+    kf = StratifiedKFold(n_splits=num_folds, shuffle=True, random_state=random_seed)
+    folds = list(kf.split(np.zeros(len(y)), y))
+
+    n_jobs = num_folds if n_jobs is None else min(n_jobs, num_folds)
+    worker_peaks = []
+    if n_jobs == 1:
+        results = [_run_fold(build_fn, X, y, train_index, val_index, random_seed, epochs=epochs, augment=augment,
+                             fold=fold)
+                   for fold, (train_index, val_index) in enumerate(folds)]
+    else:
+        # split the cores evenly between the workers, TensorFlow would otherwise start one thread per core in each
+        num_threads = max(1, (os.cpu_count() or 1) // n_jobs)
+        source = _worker_source(X)
+        # TensorFlow is not fork-safe, the workers start from a fresh interpreter
+        with ProcessPoolExecutor(max_workers=n_jobs,
+                                 mp_context=multiprocessing.get_context('spawn'),
+                                 initializer=_init_worker,
+                                 initargs=(num_threads, )) as pool:
+            futures = []
+            for fold, (train_index, val_index) in enumerate(folds):
+                args = (build_fn, source, y, train_index, val_index, random_seed, num_threads, epochs, augment, fold)
+                # the profiler of the parent never sees the workers, every fold runs its own
+                profile_dir = trace.tf_profile_dir()
+                profile_dir = None if profile_dir is None else os.path.join(profile_dir, 'fold{}'.format(fold))
+                futures.append(pool.submit(_run_fold_in_worker, trace.active(), profile_dir, *args))
+            results = [future.result() for future in futures]
+        for result in results:
+            worker_peaks.append(result[2])
+            trace.merge(result[3])                              # Events of the worker processes
+        results = [result[:2] for result in results]
+
+    # save the predictions of every fold
+    for val_index, y_val_pred_probs in results:
+        prediction_scores[val_index] = y_val_pred_probs
+
+    if return_stats:
+        return prediction_scores, {'worker_peak_rss_mb': max(worker_peaks) if worker_peaks else None}
+    return prediction_scores
@@ -0,0 +1,304 @@
+'''Loading, caching and streaming the tiles for training and prediction
+
+pandas, PIL and TensorFlow are imported by the functions that use them, so the light
+commands (e.g. predicting with a TFLite model) never load TensorFlow.
+'''
+import os
+import time
+import hashlib
+import resource
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from . import trace
+
+
+def _cache_key(dir_labels, fnames):
+    '''
+    dir_labels: Respective csv file containing ids and labels
+    fnames: Image file names listed in the csv
+    returns: Short content hash of the csv and of the size/mtime of every image,
+             so editing the labels or touching any image invalidates the cache
+    '''
+    digest = hashlib.sha1()
+    with open(dir_labels, 'rb') as f:
+        digest.update(f.read())                                 # Hash the csv contents
+    for fname in fnames:
+        stat = os.stat(fname)                                   # Cheap metadata check instead of re-reading every image
+        digest.update(('%s:%d:%d;' % (fname, stat.st_size, stat.st_mtime_ns)).encode())
+    return digest.hexdigest()[:16]
+
+def read_image(fname):
+    '''
+    fname: Image file
+    returns: The image as a numpy array, uint8 for the .tif tiles
+    '''
+    from PIL import Image
+    with Image.open(fname) as image:
+        return np.asarray(image)
+
+def decode_tiles(fnames, num_workers=None, allocate=None):
+    '''
+    fnames: Image file names
+    num_workers: Number of decoding threads, None lets the thread pool decide
+    allocate: Function returning the uint8 output array for a given shape, None for np.empty
+    returns: Array of all the images, decoded in parallel straight into the output array
+    '''
+    with trace.stage('decode', items=len(fnames)):
+        first = read_image(fnames[0])                           # Decode one image to learn the tile shape
+        shape = (len(fnames),) + first.shape
+        data = np.empty(shape, dtype=np.uint8) if allocate is None else allocate(shape)   # Preallocate the whole array once
+        data[0] = first
+
+        def decode(i):
+            data[i] = read_image(fnames[i])                     # Each worker writes straight into its own slot
+
+        with ThreadPoolExecutor(max_workers=num_workers) as pool:   # Image decoding releases the GIL, so threads run in parallel
+            list(pool.map(decode, range(1, len(fnames))))
+    return data
+
+def list_tiles(dir_data, dir_labels):
+    '''
+    dir_data: Data directory
+    dir_labels: Respective csv file containing ids and labels
+    returns: List of the image file names and array of the respective labels, no image is read
+    '''
+    import pandas as pd
+    with trace.stage('csv_read'):
+        labels_pd = pd.read_csv(dir_labels)                     # Read the csv file with labels and ids as we saw above
+    ids = labels_pd.id.values                                   # Extracting ids from the csv file
+    fnames = [os.path.join(dir_data, identifier.astype(str) + '.tif') for identifier in ids]   # Generating the file names
+    labels = labels_pd.label.values                             # Extract labels from the csv file
+    return fnames, labels
+
+def tile_ids(dir_labels):
+    '''
+    dir_labels: Respective csv file containing ids and labels
+    returns: Array of the tile ids, in the order of the rows of load_data
+    '''
+    import pandas as pd
+    with trace.stage('csv_read'):
+        return pd.read_csv(dir_labels, usecols=['id']).id.values
+
+def load_data(dir_data, dir_labels, cache_dir=None, num_workers=None, refresh=False, timing=False):
+    '''
+    dir_data: Data directory
+    dir_labels: Respective csv file containing ids and labels
+    cache_dir: Directory of the decoded image cache, None disables caching
+    num_workers: Number of decoding threads, None lets the thread pool decide
+    refresh: Decode the images again even if they are already cached
+    timing: Print the loading throughput in tiles/sec
+    returns: Array of all the image arrays and its respective labels. With a cache_dir
+             the images stay uint8 on disk and the array is a read-only np.memmap
+    '''
+    start = time.perf_counter()
+    fnames, labels = list_tiles(dir_data, dir_labels)
+
+    cache_path = None
+    if cache_dir is not None:
+        cache_path = os.path.join(cache_dir, 'tiles-' + _cache_key(dir_labels, fnames) + '.npy')
+        if os.path.exists(cache_path) and not refresh:
+            data = np.load(cache_path, mmap_mode='r')           # Warm path - no decoding, pages are read on demand
+            _report_load_rate(len(data), start, 'warm', timing)
+            return data, labels
+
+    if cache_path is None:
+        data = decode_tiles(fnames, num_workers=num_workers)
+    else:
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp_path = cache_path[:-len('.npy')] + '.tmp.npy'
+        data = decode_tiles(fnames, num_workers=num_workers,    # Decode straight to disk
+                            allocate=lambda shape: np.lib.format.open_memmap(tmp_path, mode='w+',
+                                                                             dtype=np.uint8, shape=shape))
+        data.flush()
+        del data
+        os.replace(tmp_path, cache_path)                        # Atomic, a crashed run never leaves a partial cache
+        data = np.load(cache_path, mmap_mode='r')
+
+    _report_load_rate(len(data), start, 'cold', timing)
+    return data, labels                                         # Return the array of data and respective labels
+
+def _report_load_rate(num_tiles, start, path, timing):
+    '''
+    Print the tiles/sec of one load_data call when timing is enabled
+    '''
+    if timing:
+        elapsed = time.perf_counter() - start
+        print('Loaded {} tiles in {:.2f}s ({:.0f} tiles/sec, {} path)'.format(
+            num_tiles, elapsed, num_tiles / max(elapsed, 1e-9), path))
+
+def benchmark_load_data(dir_data, dir_labels, cache_dir, num_workers=None):
+    '''
+    Time load_data on the cold path (decode and write the cache) and on the
+    warm path (read the cache back)
+    returns: Dictionary of tiles/sec for both paths
+    '''
+    rates = {}
+    for path, refresh in (('cold', True), ('warm', False)):
+        start = time.perf_counter()
+        data, _ = load_data(dir_data, dir_labels, cache_dir=cache_dir, num_workers=num_workers,
+                            refresh=refresh, timing=True)
+        rates[path] = len(data) / (time.perf_counter() - start)
+    return rates
+
+def peak_rss_mb():
+    '''
+    returns: Peak resident memory of this process so far, in MB. Read from VmHWM where /proc
+             has it: ru_maxrss survives exec, so a process started by a large one reports
+             the peak of its parent
+    '''
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024          # In kB
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024     # ru_maxrss is in KB on Linux
+
+def rss_mb():
+    '''
+    returns: Current resident memory of this process, in MB (the peak where /proc is missing)
+    '''
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2**20
+    except OSError:
+        return peak_rss_mb()
+
+def normalise_batch(images):
+    '''
+    images: uint8 images (array or tensor)
+    returns: float32 tensor of the images scaled between 0 and 1
+    '''
+    import tensorflow as tf
+    if not tf.executing_eagerly():                              # Inside the input pipeline, traced by probe_input instead
+        return tf.cast(images, tf.float32) * (1 / 255.0)
+    with trace.stage('normalise', items=len(images)):
+        return tf.cast(images, tf.float32) * (1 / 255.0)
+
+def augment_batch(images, seed, max_brightness=0.1, max_contrast=0.2, min_crop=0.8):
+    '''
+    Random flips, 90 degree rotations, brightness/contrast jitter and crops of a batch
+
+    Input:
+        images: float32 batch of images scaled between 0 and 1, height equal to width
+        seed: int tensor of shape (2, ) - the same seed always gives the same augmentation
+        max_brightness: largest shift added to an image
+        max_contrast: largest relative change of the contrast of an image
+        min_crop: smallest side of a crop, relative to the side of the image
+
+    Every image of the batch draws its own transformation, all applied at once to the
+    whole batch with stateless random ops. A left-right flip, an up-down flip and a
+    transpose, each taken or not, give all the 8 flips and 90 degree rotations of a tile.
+
+    returns: The augmented batch, the same shape and scale as the images
+    '''
+    import tensorflow as tf
+
+    num_images = tf.shape(images)[0]
+    seeds = tf.random.experimental.stateless_split(seed, num=6)
+
+    def coin(seed):
+        return tf.random.stateless_uniform((num_images, 1, 1, 1), seed) < 0.5
+
+    def jitter(seed, size, low, high):
+        return tf.random.stateless_uniform((num_images, ) + size, seed, low, high)
+
+    images = tf.where(coin(seeds[0]), tf.reverse(images, axis=[2]), images)              # Left-right flip
+    images = tf.where(coin(seeds[1]), tf.reverse(images, axis=[1]), images)              # Up-down flip
+    images = tf.where(coin(seeds[2]), tf.transpose(images, [0, 2, 1, 3]), images)        # Transpose
+
+    mean = tf.reduce_mean(images, axis=[1, 2, 3], keepdims=True)
+    contrast = jitter(seeds[3], (1, 1, 1), 1 - max_contrast, 1 + max_contrast)
+    brightness = jitter(seeds[4], (1, 1, 1), -max_brightness, max_brightness)
+    images = tf.clip_by_value((images - mean) * contrast + mean + brightness, 0.0, 1.0)
+
+    # crop a random square box of every image and resize it back to the size of the image
+    size_and_offset = jitter(seeds[5], (3, ), 0.0, 1.0)
+    side = min_crop + (1 - min_crop) * size_and_offset[:, :1]
+    top_left = (1 - side) * size_and_offset[:, 1:]
+    boxes = tf.concat([top_left, top_left + side], axis=1)                               # y1, x1, y2, x2
+    return tf.image.crop_and_resize(images, boxes, tf.range(num_images), tf.shape(images)[1:3])
+
+def make_dataset(source, y, indices, batch_size=32, shuffle=False, random_seed=1, shuffle_buffer=4096,
+                 num_threads=None, augment=False):
+    '''
+    Streaming tf.data input pipeline over a subset of the tiles
+
+    Input:
+        source: uint8 images (usually the np.memmap returned by load_data), the image
+                file names from list_tiles to decode the tiles lazily, or float32 features
+                (e.g. the embeddings from embed_tiles), used as they are
+        y: labels, or None for prediction
+        indices: rows of the source that make up this dataset (e.g. one fold)
+        batch_size: number of images per batch
+        shuffle: reshuffle the rows every epoch
+        random_seed: seed of the shuffling
+        shuffle_buffer: maximum number of rows held by the shuffle buffer
+        num_threads: size of the private thread pool of the pipeline, None shares the global one
+        augment: apply augment_batch to every training batch, with a new random transformation
+                 every epoch drawn from random_seed
+
+    Tiles are read (or decoded), normalised and augmented on parallel workers and batches
+    are prefetched, so the next batch is ready as soon as the model step finishes. Only
+    the rows of the batches in flight are ever held in memory.
+    '''
+    import tensorflow as tf
+
+    if augment and y is None:
+        raise ValueError('Only training data (with labels) can be augmented')
+    indices = np.asarray(indices)
+    labels = np.zeros(len(source), dtype=np.float32) if y is None else np.asarray(y, dtype=np.float32)
+
+    dataset = tf.data.Dataset.from_tensor_slices(indices)
+    if shuffle:
+        dataset = dataset.shuffle(min(shuffle_buffer, len(indices)), seed=random_seed, reshuffle_each_iteration=True)
+
+    if isinstance(source, np.ndarray):
+        tile_shape = source.shape[1:]
+        dtype = tf.as_dtype(source.dtype)
+
+        def read(batch):
+            if shuffle:
+                batch = np.sort(batch)                          # Ascending reads are sequential on the memmap
+            with trace.stage('read_batch', items=len(batch)):
+                return source[batch], labels[batch]
+
+        dataset = dataset.batch(batch_size).map(
+            lambda batch: tf.numpy_function(read, [batch], (dtype, tf.float32)),
+            num_parallel_calls=tf.data.AUTOTUNE)
+    else:
+        tile_shape = read_image(source[0]).shape                # Decode one image to learn the tile shape
+        dtype = tf.uint8
+
+        def read(i):
+            with trace.stage('read_batch', items=1):
+                return read_image(source[i]).astype(np.uint8, copy=False), labels[i]
+
+        dataset = dataset.map(
+            lambda i: tf.numpy_function(read, [i], (tf.uint8, tf.float32)),
+            num_parallel_calls=tf.data.AUTOTUNE).batch(batch_size)
+
+    def prepare(images, batch_labels):
+        images = tf.ensure_shape(images, (None,) + tuple(tile_shape))
+        batch_labels = tf.ensure_shape(batch_labels, (None,))
+        if dtype == tf.uint8:
+            images = normalise_batch(images)
+        if y is None:
+            return images
+        return images, batch_labels
+
+    dataset = dataset.map(prepare, num_parallel_calls=tf.data.AUTOTUNE)
+    if augment:
+        # one seed per batch from a random stream that depends only on random_seed and the epoch
+        seeds = tf.data.Dataset.random(seed=random_seed, rerandomize_each_iteration=True).batch(2)
+        dataset = tf.data.Dataset.zip(dataset, seeds).map(
+            lambda batch, seed: (augment_batch(batch[0], seed), batch[1]),
+            num_parallel_calls=tf.data.AUTOTUNE)
+    if num_threads is not None:
+        options = tf.data.Options()
+        options.threading.private_threadpool_size = num_threads    # Stay inside the thread budget of this process
+        dataset = dataset.with_options(options)
+    return dataset.prefetch(tf.data.AUTOTUNE)
@@ -0,0 +1,122 @@
+'''On-disk store of the frozen-backbone features (embeddings) of the tiles
+
+The features of a frozen backbone never change, so they are computed once per tile and
+kept on disk, keyed by tile id and the content hash of the tile, in one store per
+backbone and weights file. Training and
+cross validating a head from build_head over the stored embeddings then takes seconds.
+'''
+import os
+import time
+import hashlib
+
+import numpy as np
+
+from .data import make_dataset
+
+
+def _weights_key(weights):
+    '''
+    weights: Weights file of the backbone, None for random weights
+    returns: Short content hash of the weights file, so other weights never reuse the store
+    '''
+    if weights is None:
+        return 'random'
+    digest = hashlib.sha1()
+    with open(weights, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()[:16]
+
+def store_path(store_dir, backbone, weights=None):
+    '''
+    returns: File of the embeddings of this backbone and weights file in store_dir
+    '''
+    return os.path.join(store_dir, 'embeddings-{}-{}.npy'.format(backbone, _weights_key(weights)))
+
+def _tile_digests(X):
+    '''
+    returns: Content hash of every image, so a replaced image never reuses the embedding of the old one
+    '''
+    return np.array([hashlib.blake2b(np.ascontiguousarray(tile).tobytes(), digest_size=16).digest() for tile in X],
+                    dtype='S16')
+
+def _read_store(path):
+    '''
+    returns: The ids (ascending), content hashes and embeddings in the store, memory mapped,
+             or None when there is no store (or one written before the content hashes)
+    '''
+    if not os.path.exists(path):
+        return None
+    store = np.load(path, mmap_mode='r')
+    if 'digest' not in store.dtype.names:
+        return None
+    return store['id'], store['digest'], store['features']
+
+def _write_store(path, ids, digests, features):
+    '''
+    Write the ids, content hashes and embeddings, sorted by id, as one structured array
+    '''
+    order = np.argsort(ids, kind='stable')
+    store = np.empty(len(ids), dtype=[('id', np.int64), ('digest', 'S16'),
+                                      ('features', np.float32, features.shape[1:])])
+    store['id'] = ids[order]
+    store['digest'] = digests[order]
+    store['features'] = features[order]
+    tmp_path = path[:-len('.npy')] + '.tmp.npy'
+    np.save(tmp_path, store)
+    os.replace(tmp_path, path)                                  # Atomic, a crashed run never leaves a partial store
+
+def embed_tiles(X, ids, backbone, weights=None, store_dir='embeddings', batch_size=64, refresh=False,
+                timing=False):
+    '''
+    Frozen-backbone features of the tiles, computed only for the tiles not in the store yet
+
+    Input:
+        X: uint8 images, e.g. from load_data
+        ids: tile id of every image, e.g. from tile_ids
+        backbone: one of BACKBONES in rspd.model
+        weights: locally stored weights file of the backbone (include_top=False), None for random weights
+        store_dir: directory of the embedding stores
+        batch_size: number of images per forward pass of the backbone
+        refresh: compute the features of all the tiles again
+        timing: print the number of tiles read from the store and computed, and the tiles/sec
+
+    A tile whose image changed since its embedding was stored (another content hash) is
+    embedded again.
+
+    returns: float32 array of the features of every image, in the order of X
+    '''
+    start = time.perf_counter()
+    ids = np.asarray(ids, dtype=np.int64)
+    digests = _tile_digests(X)
+    path = store_path(store_dir, backbone, weights)
+    stored = None if refresh else _read_store(path)
+
+    if stored is None:
+        missing = np.arange(len(ids))
+    else:
+        position = np.minimum(np.searchsorted(stored[0], ids), len(stored[0]) - 1)
+        missing = np.flatnonzero((stored[0][position] != ids) | (stored[1][position] != digests))
+
+    if len(missing):
+        from .model import build_backbone
+        extractor = build_backbone(backbone, weights, input_shape=X.shape[1:])
+        features = extractor.predict(make_dataset(X, None, missing, batch_size=batch_size), verbose=0)
+        features = features.astype(np.float32, copy=False)
+        new_ids, new_digests = ids[missing], digests[missing]
+        if stored is not None:                                  # Merge the new tiles into the store, replacing changed ones
+            keep = ~np.isin(stored[0], new_ids)
+            new_ids = np.concatenate([stored[0][keep], new_ids])
+            new_digests = np.concatenate([stored[1][keep], new_digests])
+            features = np.concatenate([stored[2][keep], features])
+            del stored
+        os.makedirs(store_dir, exist_ok=True)
+        _write_store(path, new_ids, new_digests, features)
+        stored = _read_store(path)
+
+    embeddings = stored[2][np.searchsorted(stored[0], ids)]    # Back to the order of X
+    if timing:
+        elapsed = time.perf_counter() - start
+        print('Embedded {} tiles in {:.2f}s ({} from the store, {} computed, {:.0f} tiles/sec)'.format(
+            len(ids), elapsed, len(ids) - len(missing), len(missing), len(ids) / max(elapsed, 1e-9)))
+    return embeddings
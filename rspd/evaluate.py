@@ -0,0 +1,130 @@
+'''Vectorised evaluation and error analysis of the prediction scores
+
+Everything is computed with numpy on float32 scores. The ROC curve, the AUC, the
+confusion matrix and the precision/recall/F1 at every threshold come from a single sort
+of the scores, and the error buckets from a single grouping of the rows.
+'''
+import numpy as np
+
+BUCKETS = ('tn', 'fp', 'fn', 'tp')                              # Order of 2 * label + predicted class
+
+
+def _as_arrays(y, scores):
+    '''
+    returns: The labels as int8 and the scores as float32 arrays
+    '''
+    y = np.asarray(y).astype(np.int8, copy=False)
+    scores = np.asarray(scores, dtype=np.float32)
+    if y.shape != scores.shape:
+        raise ValueError('{} labels but {} scores'.format(y.shape, scores.shape))
+    return y, scores
+
+def _sort_descending(y, scores):
+    '''
+    Sort the scores from the highest to the lowest, carrying the labels along
+
+    Each score and its label are packed into one uint64 key, the float32 bits mapped to
+    an unsigned integer of the same order with the label as the lowest bit, so a plain
+    sort of the keys replaces a much slower argsort and gather.
+
+    returns: The sorted scores and their labels
+    '''
+    bits = scores.view(np.uint32)
+    ordered = np.where(bits >> 31, ~bits, bits | np.uint32(0x80000000))   # Negative floats order reversed
+    keys = (ordered.astype(np.uint64) << np.uint64(1)) | y.astype(np.uint64)
+    keys.sort()
+    keys = keys[::-1]
+    ordered = (keys >> np.uint64(1)).astype(np.uint32)
+    bits = np.where(ordered >> 31, ordered & np.uint32(0x7fffffff), ~ordered)
+    return bits.view(np.float32), (keys & np.uint64(1)).astype(np.int8)
+
+def threshold_sweep(y, scores):
+    '''
+    Confusion counts, ROC and precision/recall/F1 at every distinct score threshold
+
+    Input:
+        y: true labels, 0 or 1
+        scores: prediction scores, a tile is predicted positive when its score >= threshold
+
+    The scores are sorted once from high to low; the cumulative sum of the sorted labels
+    is the number of true positives when the threshold is lowered to each score. Ties
+    are kept together by taking the last row of every run of equal scores.
+
+    returns: Dictionary of arrays, one entry per threshold from the highest to the lowest
+             score, preceded by the threshold inf where nothing is predicted positive:
+             threshold, tp, fp, fn, tn, tpr (recall), fpr, precision and f1
+    '''
+    sorted_scores, sorted_y = _sort_descending(*_as_arrays(y, scores))   # The one sort
+    last = np.r_[np.flatnonzero(np.diff(sorted_scores)), len(sorted_scores) - 1]   # Last row of every run of ties
+
+    tp = np.r_[0, np.cumsum(sorted_y, dtype=np.int64)[last]]
+    fp = np.r_[0, last + 1 - tp[1:]]
+    positives, negatives = tp[-1], fp[-1]
+
+    with np.errstate(divide='ignore', invalid='ignore'):       # No positives (or negatives) gives NaN rates
+        tpr = tp / positives
+        fpr = fp / negatives
+        precision = np.where(tp + fp > 0, tp / (tp + fp), 1.0)  # Nothing predicted positive counts as precise
+        f1 = 2 * tp / (2 * tp + fp + (positives - tp))
+    return {'threshold': np.r_[np.inf, sorted_scores[last]],
+            'tp': tp,
+            'fp': fp,
+            'fn': positives - tp,
+            'tn': negatives - fp,
+            'tpr': tpr,
+            'fpr': fpr,
+            'precision': precision,
+            'f1': f1}
+
+def roc_auc(sweep):
+    '''
+    sweep: Output of threshold_sweep
+    returns: Area under the ROC curve, by the trapezoidal rule (as sklearn's roc_auc_score)
+    '''
+    fpr, tpr = sweep['fpr'], sweep['tpr']
+    return float(np.sum(np.diff(fpr) * (tpr[1:] + tpr[:-1])) / 2)
+
+def at_threshold(sweep, threshold):
+    '''
+    sweep: Output of threshold_sweep
+    threshold: Score from which a tile is predicted positive
+    returns: Row of the sweep for this threshold, as a dictionary of numbers
+    '''
+    index = np.searchsorted(-sweep['threshold'], -threshold, side='right') - 1   # Lowest swept threshold >= threshold
+    return {key: values[index].item() for key, values in sweep.items()}
+
+def error_buckets(y, scores, threshold=0.5):
+    '''
+    y: true labels, 0 or 1
+    scores: prediction scores
+    threshold: Score from which a tile is predicted positive
+    returns: Dictionary of the row indices of the true negatives, false positives, false
+             negatives and true positives ('tn', 'fp', 'fn', 'tp'), each in ascending order
+    '''
+    y, scores = _as_arrays(y, scores)
+    codes = 2 * y + (scores >= threshold)                       # 0: tn, 1: fp, 2: fn, 3: tp
+    order = np.argsort(codes, kind='stable')                    # Groups the rows by bucket, ascending within each
+    bounds = np.cumsum(np.bincount(codes, minlength=4))[:-1]
+    return dict(zip(BUCKETS, np.split(order, bounds)))
+
+def evaluate_scores(y, scores, threshold=0.5):
+    '''
+    Full evaluation of the prediction scores
+
+    Input:
+        y: true labels, 0 or 1
+        scores: prediction scores
+        threshold: Score from which a tile is predicted positive
+
+    returns: Dictionary of the AUC, the accuracy and confusion matrix at the threshold,
+             the threshold with the best F1, the threshold sweep and the error buckets
+    '''
+    sweep = threshold_sweep(y, scores)
+    row = at_threshold(sweep, threshold)
+    best = int(np.nanargmax(sweep['f1']))
+    return {'auc': roc_auc(sweep),
+            'accuracy': (row['tp'] + row['tn']) / (row['tp'] + row['fp'] + row['fn'] + row['tn']),
+            'confusion_matrix': [[row['tn'], row['fp']], [row['fn'], row['tp']]],
+            'best_f1': {'threshold': float(sweep['threshold'][best]), 'f1': float(sweep['f1'][best])},
+            'sweep': sweep,
+            'buckets': error_buckets(y, scores, threshold)}
@@ -0,0 +1,127 @@
+'''Scoring whole aerial scenes with a trained CNN model'''
+import time
+
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+from .data import normalise_batch
+from .data import read_image
+from .model import can_be_fully_convolutional
+from .model import to_fully_convolutional
+
+
+def load_scene(fname):
+    '''
+    fname: Image file of a whole scene (e.g. an orthophoto)
+    returns: The scene as a uint8 array of shape (height, width, 3)
+    '''
+    scene = read_image(fname)
+    return scene[:, :, :3].astype(np.uint8, copy=False)           # Drop the alpha channel if there is one
+
+def window_views(scene, tile_size=101, stride=32):
+    '''
+    scene: Image of shape (height, width, channels)
+    tile_size: Height and width of the windows, the input size of the model
+    stride: Step between two windows in pixels
+    returns: Read-only view of shape (rows, cols, tile_size, tile_size, channels) of all the
+             windows of the scene, no pixel is copied
+    '''
+    views = sliding_window_view(scene, (tile_size, tile_size, scene.shape[2]))
+    return views[::stride, ::stride, 0]
+
+def _score_dense(fcn, scene, tile_size, stride, downsampling, block_windows):
+    '''
+    Score all windows with the fully-convolutional model, one block of the scene per forward pass.
+
+    Overlapping windows share their convolutions, so every pixel goes through the network
+    (about) once instead of once per window covering it. Only valid when the stride is a
+    multiple of the downsampling of the network, so that every window is one of the
+    positions of the dense score map.
+    '''
+    rows = (scene.shape[0] - tile_size) // stride + 1
+    cols = (scene.shape[1] - tile_size) // stride + 1
+    scores = np.empty((rows, cols), dtype=np.float32)
+    step = stride // downsampling
+    for r0 in range(0, rows, block_windows):
+        for c0 in range(0, cols, block_windows):
+            r1, c1 = min(r0 + block_windows, rows), min(c0 + block_windows, cols)
+            block = scene[r0 * stride:(r1 - 1) * stride + tile_size,
+                          c0 * stride:(c1 - 1) * stride + tile_size]
+            score_map = np.asarray(fcn(normalise_batch(block[None]), training=False))[0, :, :, 0]
+            scores[r0:r1, c0:c1] = score_map[::step, ::step][:r1 - r0, :c1 - c0]
+    return scores
+
+def _score_batched(model, scene, tile_size, stride, batch_size):
+    '''
+    Score all windows in fixed-size batches copied out of the zero-copy window views
+    '''
+    views = window_views(scene, tile_size, stride)
+    rows, cols = views.shape[:2]
+    views = views.reshape((rows * cols, ) + views.shape[2:])       # Still a view, windows are copied one batch at a time
+    batch = np.zeros((batch_size, ) + views.shape[1:], dtype=np.float32)   # Reused for every batch, the last one is padded
+    scores = np.empty(rows * cols, dtype=np.float32)
+    for start in range(0, len(views), batch_size):
+        n = min(batch_size, len(views) - start)
+        np.multiply(views[start:start + n], np.float32(1 / 255.0), out=batch[:n])
+        scores[start:start + n] = np.asarray(model.predict_on_batch(batch)).reshape(-1)[:n]
+    return scores.reshape(rows, cols)
+
+def stitch_heatmap(scores, scene_shape, tile_size=101, stride=32):
+    '''
+    scores: Window scores of shape (rows, cols)
+    scene_shape: Shape of the scored scene
+    returns: Probability heatmap of shape (height, width), every pixel being the mean score
+             of the windows covering it (NaN on the right/bottom margin no window reaches)
+    '''
+    rows, cols = scores.shape
+    height, width = scene_shape[:2]
+    total = np.zeros((height + 1, width + 1), dtype=np.float64)
+    count = np.zeros((height + 1, width + 1), dtype=np.float64)
+    r = np.arange(rows)[:, None] * stride
+    c = np.arange(cols)[None, :] * stride
+    r, c = np.broadcast_to(r, scores.shape), np.broadcast_to(c, scores.shape)
+    # add every window to its footprint with a 2d difference array, then integrate
+    for dr, dc, sign in ((0, 0, 1), (0, tile_size, -1), (tile_size, 0, -1), (tile_size, tile_size, 1)):
+        np.add.at(total, (r + dr, c + dc), sign * scores)
+        np.add.at(count, (r + dr, c + dc), sign)
+    total = total.cumsum(axis=0).cumsum(axis=1)[:height, :width]
+    count = count.cumsum(axis=0).cumsum(axis=1)[:height, :width]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return (total / count).astype(np.float32)
+
+def predict_scene(model, scene, tile_size=101, stride=32, batch_size=256, block_windows=32,
+                  pixel_size_m=0.3, timing=False):
+    '''
+    Sliding-window inference over a whole scene
+
+    Input:
+        model: Trained Keras model, from build_model() with or without a backbone
+        scene: uint8 image of shape (height, width, 3), e.g. from load_scene
+        tile_size: Height and width of the windows, the input size of the model
+        stride: Step between two windows in pixels
+        batch_size: Number of windows per model call when the trunk cannot be shared
+        block_windows: Number of window rows/cols per block of the fully-convolutional pass
+        pixel_size_m: Ground size of one pixel in metres, for the throughput
+        timing: Print the throughput in km²/min
+
+    When the model is the custom CNN and the stride is a multiple of its downsampling (4),
+    the fully-convolutional version of the model scores a whole block of the scene per
+    forward pass and overlapping windows share their convolutions. Otherwise (other
+    strides, backbone models) the windows are scored independently in batches.
+
+    returns: Window scores of shape (rows, cols) and the stitched heatmap of shape (height, width)
+    '''
+    start = time.perf_counter()
+    fcn, downsampling = to_fully_convolutional(model) if can_be_fully_convolutional(model) else (None, None)
+    if fcn is not None and stride % downsampling == 0:
+        scores = _score_dense(fcn, scene, tile_size, stride, downsampling, block_windows)
+    else:
+        scores = _score_batched(model, scene, tile_size, stride, batch_size)
+    heatmap = stitch_heatmap(scores, scene.shape, tile_size, stride)
+
+    if timing:
+        elapsed = time.perf_counter() - start
+        area_km2 = scene.shape[0] * scene.shape[1] * pixel_size_m ** 2 / 1e6
+        print('Scored {} windows over {:.3f} km² in {:.2f}s ({:.3f} km²/min)'.format(
+            scores.size, area_km2, elapsed, area_km2 / elapsed * 60))
+    return scores, heatmap
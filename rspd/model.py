@@ -0,0 +1,228 @@
+'''The CNN model, and the transfer-learning models on a pretrained backbone'''
+import numpy as np
+import keras
+from keras.layers import Input
+from keras.layers import Conv2D
+from keras.layers import Dense
+from keras.layers import GlobalMaxPooling2D
+from keras.layers import MaxPooling2D
+from keras.layers import BatchNormalization
+from keras.layers import Dropout
+from keras.layers import Rescaling
+from keras.models import Sequential
+
+# backbone name: (keras.applications class, scale and offset mapping images in [0, 1] to its input range)
+BACKBONES = {
+    'mobilenet_v2': ('MobileNetV2', 2.0, -1.0),
+    'resnet50_v2': ('ResNet50V2', 2.0, -1.0),
+    'efficientnet_b0': ('EfficientNetB0', 255.0, 0.0),
+}
+
+
+# define CNN
+def build_model(backbone=None, weights=None):
+    '''
+    Returns a Keras CNN model
+
+    backbone: None for the custom CNN below, or one of BACKBONES for a frozen pretrained
+              backbone with a small trainable head on top (see build_backbone and build_head)
+    weights: locally stored weights file of the backbone (include_top=False), None for random weights
+    '''
+    if backbone is not None:
+        extractor = build_backbone(backbone, weights)
+        return attach_head(extractor, build_head(extractor.output_shape[-1]))
+
+    # define image dimensions
+    IMAGE_HEIGHT = 101
+    IMAGE_WIDTH = 101
+    IMAGE_CHANNELS = 3
+
+    # define a straightforward sequential neural network
+    model = Sequential()
+
+    # layer-1
+    #filter is convolutional matrix which is applied across the image = 32 filters
+    #kernal size is 3x3 matrix(filter)
+    #relu positive kept as it is, negative is taken out
+    model.add(Conv2D(filters=32,
+                     kernel_size=3,
+                     activation='relu',
+                     input_shape=(IMAGE_HEIGHT,
+                                  IMAGE_WIDTH,
+                                  IMAGE_CHANNELS)))
+
+    #adding normalizing layer to improve the speed of training
+    model.add(BatchNormalization())
+
+    # As we move forword in the layers pattern gets more complex,
+    # to capture the maximum combinations in subsequent layers
+    # layer-2
+    model.add(Conv2D(filters=64,
+                     kernel_size=3,
+                     activation='relu'))
+    model.add(BatchNormalization())
+
+    # layer-3
+    model.add(Conv2D(filters=128,
+                     kernel_size=3,
+                     activation='relu'))
+    model.add(BatchNormalization())
+
+    # Pooling layer is to reduce dimentions of feature map by summerizing presence of features
+    # max-pool - sends only imp data to next layer - here 2x2 matrix
+    model.add(MaxPooling2D(pool_size=2))
+
+    # layer-4
+    model.add(Conv2D(filters=64,
+                     kernel_size=3,
+                     activation='relu'))
+    model.add(BatchNormalization())
+
+    # layer-5
+    model.add(Conv2D(filters=128,
+                     kernel_size=3,
+                     activation='relu'))
+    model.add(BatchNormalization())
+
+    # max-pool
+    model.add(MaxPooling2D(pool_size=2))
+
+    # layer-6
+    model.add(Conv2D(filters=64,
+                     kernel_size=3,
+                     activation='relu'))
+    model.add(BatchNormalization())
+
+    # layer-7
+    model.add(Conv2D(filters=128,
+                     kernel_size=3,
+                     activation='relu'))
+    model.add(BatchNormalization())
+
+    # gobal-max-pool- performs downsampling by computing the maximum of the height and width dimensions of the input
+    # using it as a substitute of Flatten before passing it to the final layer
+    model.add(GlobalMaxPooling2D())
+
+    # output layer
+    model.add(Dense(1, activation='sigmoid'))
+
+    # compile model
+    model.compile(optimizer='adam', loss='binary_crossentropy', metrics=['accuracy'])
+
+    return model
+
+def can_be_fully_convolutional(model):
+    '''
+    returns: True when to_fully_convolutional can rewrite the model, i.e. it is built like
+             build_model() (the backbone models pool inside the pretrained network)
+    '''
+    return any(isinstance(layer, GlobalMaxPooling2D) for layer in model.layers)
+
+def to_fully_convolutional(model):
+    '''
+    Rewrite a trained build_model() network into an equivalent fully-convolutional one
+
+    The global max-pool becomes a max-pool with a stride of 1 over windows the size of
+    the feature map of one tile, and the Dense layer becomes a 1x1 convolution with the
+    same weights. The new model accepts images of any size and outputs, in a single
+    forward pass, the score of every tile-sized window of the image at a step equal to
+    the downsampling of the network (4 pixels for build_model()). Score [i, j] is the
+    score the original model gives the tile whose top-left corner is at
+    (i * downsampling, j * downsampling).
+
+    returns: The fully-convolutional model and its downsampling
+    '''
+    tile_shape = tuple(model.input_shape[1:])
+    fcn = Sequential()
+    fcn.add(Input(shape=(None, None, tile_shape[2])))
+
+    weights = []
+    downsampling = 1
+    pooled = False
+    for layer in model.layers:
+        if isinstance(layer, GlobalMaxPooling2D):
+            # the max over the whole feature map of one tile, slid over the feature map of the image
+            feature_shape = fcn(np.zeros((1, ) + tile_shape, dtype=np.float32)).shape[1:3]
+            fcn.add(MaxPooling2D(pool_size=tuple(feature_shape), strides=1))
+            pooled = True
+        elif isinstance(layer, Dense):
+            config = layer.get_config()
+            conv = Conv2D(filters=config['units'],
+                          kernel_size=1,
+                          activation=config['activation'],
+                          use_bias=config['use_bias'])
+            fcn.add(conv)
+            kernel = layer.get_weights()[0]
+            weights.append((conv, [kernel.reshape((1, 1) + kernel.shape)] + layer.get_weights()[1:]))
+        else:
+            clone = layer.__class__.from_config(layer.get_config())
+            fcn.add(clone)
+            weights.append((clone, layer.get_weights()))
+            if not pooled:
+                downsampling *= getattr(layer, 'strides', (1, ))[0]   # Pooling layers stride by their pool size
+
+    if not pooled:
+        raise ValueError('The model has no GlobalMaxPooling2D layer to convert')
+
+    for layer, layer_weights in weights:
+        layer.set_weights(layer_weights)
+    return fcn, downsampling
+
+def build_backbone(backbone, weights=None, input_shape=(101, 101, 3)):
+    '''
+    Frozen feature extractor of a pretrained backbone
+
+    Input:
+        backbone: one of BACKBONES
+        weights: locally stored weights file of the backbone without its top
+                 (include_top=False), so nothing is downloaded; None for random weights
+        input_shape: shape of the tiles
+
+    returns: Model turning images scaled between 0 and 1 into one feature vector per image
+             (the global average of the last feature map of the backbone)
+    '''
+    if backbone not in BACKBONES:
+        raise ValueError('Unknown backbone {!r}, expected one of {}'.format(backbone, ', '.join(BACKBONES)))
+    name, scale, offset = BACKBONES[backbone]
+    network = getattr(keras.applications, name)(include_top=False, weights=weights, input_shape=input_shape,
+                                                 pooling='avg')
+    network.trainable = False
+
+    extractor = Sequential(name=backbone)
+    extractor.add(Input(shape=input_shape))
+    extractor.add(Rescaling(scale, offset=offset))              # The input range the backbone was trained on
+    extractor.add(network)
+    return extractor
+
+def build_head(num_features, hidden_units=128, dropout=0.2, learning_rate=1e-3):
+    '''
+    Small classifier trained on the features of a frozen backbone
+
+    Input:
+        num_features: length of the feature vectors
+        hidden_units: width of the hidden layer
+        dropout: dropout rate after the hidden layer
+        learning_rate: learning rate of Adam
+
+    returns: Compiled Keras model from a feature vector to the probability of a solar panel
+    '''
+    head = Sequential()
+    head.add(Input(shape=(num_features, )))
+    head.add(Dense(hidden_units, activation='relu'))
+    head.add(Dropout(dropout))
+    head.add(Dense(1, activation='sigmoid'))
+    head.compile(optimizer=keras.optimizers.Adam(learning_rate), loss='binary_crossentropy', metrics=['accuracy'])
+    return head
+
+def attach_head(extractor, head):
+    '''
+    extractor: Frozen feature extractor from build_backbone
+    head: Head from build_head, e.g. trained on cached embeddings of the same extractor
+    returns: Compiled model scoring tiles end to end, like the one of build_model
+    '''
+    model = Sequential()
+    model.add(Input(shape=extractor.input_shape[1:]))
+    model.add(extractor)
+    model.add(head)
+    model.compile(optimizer='adam', loss='binary_crossentropy', metrics=['accuracy'])
+    return model
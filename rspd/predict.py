@@ -0,0 +1,242 @@
+'''Scoring tile files with a saved model, with a persistent prediction cache
+
+Nightly rescoring of the same tile directories mostly sees unchanged tiles and the same
+model. PredictionCache keeps every score in SQLite keyed by the content hash of the tile
+and the fingerprint of the model, so predict_tiles only decodes and scores the new or
+changed tiles, and does not even load the model when every tile is cached.
+'''
+import os
+import time
+import sqlite3
+import hashlib
+import zipfile
+
+import numpy as np
+
+from . import trace
+from .data import decode_tiles
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, digest TEXT);
+CREATE TABLE IF NOT EXISTS models (model TEXT PRIMARY KEY, path TEXT, last_used REAL, seconds_per_tile REAL);
+CREATE TABLE IF NOT EXISTS predictions (model TEXT, digest TEXT, score REAL, last_used REAL,
+                                        PRIMARY KEY (model, digest));
+CREATE INDEX IF NOT EXISTS predictions_last_used ON predictions (last_used);
+'''
+
+
+def model_fingerprint(model_path):
+    '''
+    model_path: Saved Keras model (.keras) or TFLite model (.tflite)
+    returns: Short content hash of the model. For a .keras archive the save date in its
+             metadata is left out, so saving the same weights again keeps the fingerprint
+    '''
+    digest = hashlib.sha1()
+    if zipfile.is_zipfile(model_path):
+        with zipfile.ZipFile(model_path) as archive:
+            for name in sorted(archive.namelist()):
+                if name != 'metadata.json':
+                    digest.update(name.encode())
+                    digest.update(archive.read(name))
+    else:
+        with open(model_path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                digest.update(block)
+    return digest.hexdigest()[:16]
+
+def _file_digest(fname):
+    '''
+    returns: Content hash of the file
+    '''
+    with open(fname, 'rb') as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+class PredictionCache:
+    '''
+    SQLite store of the scores of tiles, keyed by tile content hash and model fingerprint
+
+    Input:
+        path: SQLite database file, created when missing
+        keep_models: number of most recently used model versions whose scores are kept by evict
+        max_entries: largest number of scores kept by evict, the least recently used go
+                     first; None for no limit
+
+    The content hash of a file is remembered with its size and modification time, so an
+    unchanged file is never read again to be hashed.
+    '''
+
+    def __init__(self, path, keep_models=2, max_entries=None):
+        self.keep_models = keep_models
+        self.max_entries = max_entries
+        self.db = sqlite3.connect(path)
+        self.db.executescript(_SCHEMA)
+
+    def close(self):
+        self.db.close()
+
+    def model_version(self, model_path):
+        '''
+        returns: Fingerprint of the model, recorded as its most recently used version
+        '''
+        model = model_fingerprint(model_path)
+        with self.db:
+            self.db.execute('INSERT INTO models (model, path, last_used) VALUES (?, ?, ?) '
+                            'ON CONFLICT (model) DO UPDATE SET path = excluded.path, last_used = excluded.last_used',
+                            (model, os.path.abspath(model_path), time.time()))
+        return model
+
+    def tile_digests(self, fnames):
+        '''
+        returns: Content hash of every file, only the new or modified files are read
+        '''
+        known = {path: (size, mtime_ns, digest) for path, size, mtime_ns, digest
+                 in self.db.execute('SELECT path, size, mtime_ns, digest FROM files')}
+        digests, changed = [], []
+        for fname in fnames:
+            path = os.path.abspath(fname)
+            stat = os.stat(path)
+            entry = known.get(path)
+            if entry is not None and entry[:2] == (stat.st_size, stat.st_mtime_ns):
+                digests.append(entry[2])
+            else:
+                digest = _file_digest(path)
+                digests.append(digest)
+                changed.append((path, stat.st_size, stat.st_mtime_ns, digest))
+        with self.db:
+            self.db.executemany('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?)', changed)
+        return digests
+
+    def lookup(self, model, digests):
+        '''
+        returns: Dictionary of the cached scores of the model for the given content hashes
+        '''
+        with self.db:
+            self.db.execute('CREATE TEMP TABLE IF NOT EXISTS wanted (digest TEXT PRIMARY KEY)')
+            self.db.execute('DELETE FROM wanted')
+            self.db.executemany('INSERT OR IGNORE INTO wanted VALUES (?)', ((digest, ) for digest in digests))
+            self.db.execute('UPDATE predictions SET last_used = ? WHERE model = ? AND digest IN (SELECT digest FROM wanted)',
+                            (time.time(), model))
+        return dict(self.db.execute('SELECT p.digest, p.score FROM predictions p JOIN wanted w ON p.digest = w.digest '
+                                    'WHERE p.model = ?', (model, )))
+
+    def store(self, model, digests, scores, seconds_per_tile=None):
+        '''
+        Save the scores of the model for the content hashes, with the measured cost of
+        scoring a tile (decoding included) used to estimate the time saved by the cache
+        '''
+        now = time.time()
+        with self.db:
+            self.db.executemany('INSERT OR REPLACE INTO predictions VALUES (?, ?, ?, ?)',
+                                ((model, digest, float(score), now) for digest, score in zip(digests, scores)))
+            if seconds_per_tile is not None:
+                self.db.execute('UPDATE models SET seconds_per_tile = ? WHERE model = ?', (seconds_per_tile, model))
+
+    def seconds_per_tile(self, model):
+        '''
+        returns: Last measured cost of scoring one tile with the model, None if never measured
+        '''
+        row = self.db.execute('SELECT seconds_per_tile FROM models WHERE model = ?', (model, )).fetchone()
+        return None if row is None else row[0]
+
+    def evict(self):
+        '''
+        Drop the scores of all but the keep_models most recently used model versions, then
+        the least recently used scores beyond max_entries, and the hashes of deleted files
+        returns: Number of scores dropped
+        '''
+        with self.db:
+            stale = [model for model, in self.db.execute('SELECT model FROM models ORDER BY last_used DESC LIMIT -1 OFFSET ?',
+                                                         (self.keep_models, ))]
+            dropped = 0
+            for model in stale:
+                dropped += self.db.execute('DELETE FROM predictions WHERE model = ?', (model, )).rowcount
+                self.db.execute('DELETE FROM models WHERE model = ?', (model, ))
+            if self.max_entries is not None:
+                dropped += self.db.execute('DELETE FROM predictions WHERE rowid IN (SELECT rowid FROM predictions '
+                                           'ORDER BY last_used DESC LIMIT -1 OFFSET ?)', (self.max_entries, )).rowcount
+            gone = [(path, ) for path, in self.db.execute('SELECT path FROM files') if not os.path.exists(path)]
+            self.db.executemany('DELETE FROM files WHERE path = ?', gone)
+        return dropped
+
+    def __len__(self):
+        return self.db.execute('SELECT COUNT(*) FROM predictions').fetchone()[0]
+
+def score_files(scorer, fnames, batch_size=64, num_workers=None):
+    '''
+    scorer: Function scoring a batch of uint8 images, e.g. from load_scorer
+    fnames: Image file names
+    batch_size: Number of images per call of the scorer
+    num_workers: Number of decoding threads
+    returns: float32 scores of the images, decoded a chunk at a time so memory stays bounded
+    '''
+    scores = np.empty(len(fnames), dtype=np.float32)
+    chunk = 16 * batch_size                                     # Tiles decoded at a time
+    for start in range(0, len(fnames), chunk):
+        images = decode_tiles(fnames[start:start + chunk], num_workers=num_workers)
+        with trace.stage('predict', items=len(images)):
+            for batch_start in range(0, len(images), batch_size):
+                rows = slice(start + batch_start, start + batch_start + batch_size)
+                scores[rows] = scorer(images[batch_start:batch_start + batch_size])
+    return scores
+
+def predict_tiles(model_path, fnames, cache=None, batch_size=64, num_workers=None):
+    '''
+    Score tile files with a saved model, reusing the cached scores of unchanged tiles
+
+    Input:
+        model_path: Saved Keras model or TFLite model, see load_scorer
+        fnames: Image file names
+        cache: PredictionCache, None to score every tile
+        batch_size: Number of images per call of the model
+        num_workers: Number of decoding threads
+
+    returns: float32 scores of the tiles, and a dictionary of statistics: number of tiles,
+             cache hits (files whose score was already cached) and misses, hit rate, the
+             number of tiles scored and of files sharing the score of another file of the
+             run, seconds spent hashing and scoring, the estimated seconds saved by the
+             cache (the hits times the last measured cost of scoring a tile, less the
+             hashing) and the number of evicted scores
+    '''
+    from .serve import load_scorer
+
+    if cache is None:
+        start = time.perf_counter()
+        scores = score_files(load_scorer(model_path, max_batch=batch_size), fnames, batch_size, num_workers)
+        return scores, {'tiles': len(fnames), 'score_sec': time.perf_counter() - start}
+
+    start = time.perf_counter()
+    model = cache.model_version(model_path)
+    digests = cache.tile_digests(fnames)
+    cached = cache.lookup(model, digests)
+    hash_sec = time.perf_counter() - start
+    hits = sum(digest in cached for digest in digests)          # Files whose score was cached before this run
+
+    # score every new content hash once, even when several files hold the same tile
+    first_file = {}
+    for fname, digest in zip(fnames, digests):
+        if digest not in cached:
+            first_file.setdefault(digest, fname)
+
+    start = time.perf_counter()
+    if first_file:
+        scorer = load_scorer(model_path, max_batch=batch_size)
+        scoring = time.perf_counter()
+        new_scores = score_files(scorer, list(first_file.values()), batch_size, num_workers)
+        seconds_per_tile = (time.perf_counter() - scoring) / len(first_file)    # Decoding and scoring, not loading
+        cache.store(model, first_file, new_scores, seconds_per_tile=seconds_per_tile)
+        cached.update(zip(first_file, new_scores.tolist()))
+    score_sec = time.perf_counter() - start
+
+    misses = len(fnames) - hits
+    scores = np.array([cached[digest] for digest in digests], dtype=np.float32)
+    seconds_per_tile = cache.seconds_per_tile(model)
+    return scores, {'tiles': len(fnames),
+                    'hits': hits,
+                    'misses': misses,
+                    'scored': len(first_file),
+                    'deduplicated': misses - len(first_file),
+                    'hit_rate': hits / max(len(fnames), 1),
+                    'hash_sec': hash_sec,
+                    'score_sec': score_sec,
+                    'time_saved_sec': None if seconds_per_tile is None else hits * seconds_per_tile - hash_sec,
+                    'evicted': cache.evict()}
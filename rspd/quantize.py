@@ -0,0 +1,303 @@
+'''Exporting the CNN model as an int8 TFLite model for CPU serving
+
+TensorFlow and Keras are imported by the functions that use them, so
+TFLiteModel can serve a model with a standalone TFLite runtime only.
+'''
+import os
+import sys
+import json
+import time
+import tempfile
+import subprocess
+
+import numpy as np
+
+from .data import normalise_batch
+from .data import peak_rss_mb
+from .data import rss_mb
+
+
+def _batch_norm_affine(layer):
+    '''
+    layer: BatchNormalization layer
+    returns: Per-channel scale and shift the layer applies at inference time
+    '''
+    config = layer.get_config()
+    weights = layer.get_weights()
+    gamma = weights.pop(0) if config['scale'] else 1.0
+    beta = weights.pop(0) if config['center'] else 0.0
+    mean, variance = weights
+    scale = gamma / np.sqrt(variance + config['epsilon'])
+    return scale, beta - mean * scale
+
+def fold_batch_norm(model):
+    '''
+    Copy of a trained build_model() network with its BatchNormalization layers folded away
+
+    In build_model() every BatchNormalization comes after the ReLU of its convolution, so
+    it cannot be folded into the preceding convolution. It is a per-channel affine map of
+    the input of the next layer instead, and is folded into the next Conv2D (valid
+    padding) or Dense layer. It is carried through a max-pool in between when all its
+    scales are positive, as a max-pool commutes with an increasing map. A BatchNormalization
+    that cannot be folded is kept as it is.
+
+    returns: The folded model
+    '''
+    from keras.layers import Input
+    from keras.layers import Conv2D
+    from keras.layers import Dense
+    from keras.layers import BatchNormalization
+    from keras.layers import MaxPooling2D
+    from keras.layers import GlobalMaxPooling2D
+    from keras.models import Sequential
+
+    layers = []                                                   # (new layer, its weights)
+    pending = None                                                # BatchNormalization not folded yet
+
+    def emit_pending():
+        clone = BatchNormalization.from_config(pending.get_config())
+        layers.append((clone, pending.get_weights()))
+
+    for layer in model.layers:
+        if isinstance(layer, BatchNormalization):
+            if pending is not None:
+                emit_pending()
+            pending = layer
+            continue
+
+        config = layer.get_config()
+        weights = layer.get_weights()
+        if pending is not None:
+            scale, shift = _batch_norm_affine(pending)
+            if isinstance(layer, (MaxPooling2D, GlobalMaxPooling2D)) and np.all(scale > 0):
+                pass                                              # Carried through to the layer after the pool
+            elif isinstance(layer, Conv2D) and config['padding'] == 'valid' and config.get('groups', 1) == 1:
+                kernel = weights[0]
+                bias = weights[1] if config['use_bias'] else np.zeros(kernel.shape[-1], kernel.dtype)
+                bias = bias + np.einsum('hwio,i->o', kernel, shift)
+                weights = [kernel * scale[:, None], bias]
+                config['use_bias'] = True
+                pending = None
+            elif isinstance(layer, Dense):
+                kernel = weights[0]
+                bias = weights[1] if config['use_bias'] else np.zeros(kernel.shape[-1], kernel.dtype)
+                weights = [kernel * scale[:, None], bias + shift @ kernel]
+                config['use_bias'] = True
+                pending = None
+            else:
+                emit_pending()
+                pending = None
+
+        clone = layer.__class__.from_config(config)
+        layers.append((clone, weights))
+
+    if pending is not None:
+        emit_pending()
+
+    folded = Sequential()
+    folded.add(Input(shape=tuple(model.input_shape[1:])))
+    for layer, _ in layers:
+        folded.add(layer)
+    for layer, weights in layers:
+        layer.set_weights(weights)
+    return folded
+
+def quantize_model(model, calibration_images, path):
+    '''
+    Fold the BatchNormalization layers of a trained model, quantise it to int8 and save it as TFLite
+
+    Input:
+        model: Trained Keras model built like build_model()
+        calibration_images: uint8 images the activation ranges are calibrated on, e.g. a
+                            few hundred training images from load_data
+        path: TFLite file to write
+
+    The model takes the uint8 pixels directly and outputs float32 scores.
+
+    returns: Size of the TFLite file in bytes
+    '''
+    import tensorflow as tf
+
+    folded = fold_batch_norm(model)
+
+    def representative_dataset():
+        for image in calibration_images:
+            yield [normalise_batch(image[None])]
+
+    converter = tf.lite.TFLiteConverter.from_keras_model(folded)
+    converter.optimizations = [tf.lite.Optimize.DEFAULT]
+    converter.representative_dataset = representative_dataset
+    converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS_INT8]
+    converter.inference_input_type = tf.uint8
+    converter.inference_output_type = tf.float32
+    tflite_model = converter.convert()
+
+    with open(path, 'wb') as f:
+        f.write(tflite_model)
+    return len(tflite_model)
+
+class TFLiteModel:
+    '''
+    Inference wrapper of a TFLite model written by quantize_model
+
+    Input:
+        path: TFLite file
+        batch_size: largest number of images per interpreter call
+        num_threads: number of interpreter threads, None for the default
+
+    One interpreter is allocated per power-of-two batch size up to batch_size (on first
+    use), and every call uses the smallest one that fits, so a small batch is never padded
+    to a large one. Uses a standalone TFLite runtime (ai_edge_litert or tflite_runtime)
+    when one is installed, so serving does not need TensorFlow, and falls back to tf.lite
+    otherwise.
+    '''
+
+    def __init__(self, path, batch_size=64, num_threads=None):
+        try:
+            from ai_edge_litert.interpreter import Interpreter
+        except ImportError:
+            try:
+                from tflite_runtime.interpreter import Interpreter
+            except ImportError:
+                import tensorflow as tf
+                Interpreter = tf.lite.Interpreter
+        self.path = path
+        self.batch_size = batch_size
+        self.num_threads = num_threads
+        self.interpreter_class = Interpreter
+        self.interpreters = {}                                    # Batch size -> allocated interpreter
+        interpreter = self._interpreter(1)
+        self.input = interpreter.get_input_details()[0]
+        self.output = interpreter.get_output_details()[0]
+
+    def _interpreter(self, n):
+        '''
+        returns: The interpreter of the smallest power-of-two batch size holding n images, and its batch size
+        '''
+        size = min(self.batch_size, 1 << (int(n) - 1).bit_length())
+        if size not in self.interpreters:
+            interpreter = self.interpreter_class(model_path=self.path, num_threads=self.num_threads)
+            input_details = interpreter.get_input_details()[0]
+            interpreter.resize_tensor_input(input_details['index'], [size] + list(input_details['shape'][1:]))
+            interpreter.allocate_tensors()
+            self.interpreters[size] = interpreter
+        return self.interpreters[size]
+
+    def _quantize_input(self, images):
+        '''
+        Map uint8 pixels to the quantised input of the model (the pixels scaled between 0 and 1, quantised)
+        '''
+        scale, zero_point = self.input['quantization']
+        if self.input['dtype'] == np.float32:
+            return np.multiply(images, np.float32(1 / 255.0), dtype=np.float32)
+        if np.isclose(scale * 255.0, 1.0) and zero_point == 0:
+            return images.astype(self.input['dtype'], copy=False)    # Usual case, the pixels are the quantised input
+        info = np.iinfo(self.input['dtype'])
+        quantized = np.rint(images / (255.0 * scale) + zero_point)
+        return np.clip(quantized, info.min, info.max).astype(self.input['dtype'])
+
+    def predict(self, images):
+        '''
+        images: uint8 images of shape (N, 101, 101, 3)
+        returns: float32 scores of shape (N, )
+        '''
+        scores = np.empty(len(images), dtype=np.float32)
+        for start in range(0, len(images), self.batch_size):
+            n = min(self.batch_size, len(images) - start)
+            interpreter = self._interpreter(n)
+            batch = np.zeros(interpreter.get_input_details()[0]['shape'], dtype=self.input['dtype'])
+            batch[:n] = self._quantize_input(np.asarray(images[start:start + n]))
+            interpreter.set_tensor(self.input['index'], batch)
+            interpreter.invoke()
+            output = interpreter.get_tensor(self.output['index']).reshape(-1)
+            scale, zero_point = self.output['quantization']
+            if self.output['dtype'] != np.float32:
+                output = (output.astype(np.float32) - zero_point) * scale
+            scores[start:start + n] = output[:n]
+        return scores
+
+def _serving_memory(model_path, images_path, batch_size):
+    '''
+    Load a saved model with load_scorer and score the saved images, run by serving_memory
+
+    returns: Resident memory of the process before loading the model and its peak while
+             loading it (runtime included) and scoring, in MB
+    '''
+    from .serve import load_scorer
+    images, batch_size = np.load(images_path), int(batch_size)
+    before = rss_mb()
+    scorer = load_scorer(model_path, max_batch=batch_size)
+    for start in range(0, len(images), batch_size):             # The scorer takes at most max_batch images
+        scorer(images[start:start + batch_size])
+    return before, peak_rss_mb()
+
+def serving_memory(model_path, images, batch_size=64):
+    '''
+    model_path: Saved Keras model or TFLite model, see load_scorer
+    images: uint8 images scored after loading, a few batches are enough for the activations
+    batch_size: number of images per call of the model
+    returns: Dictionary of the peak resident memory of a fresh process serving the model
+             ('serving_rss_mb') and how much loading and scoring added to it
+             ('serving_rss_growth_mb': the runtime, the model and its activations)
+    '''
+    # a fresh interpreter, which only loads the runtime this model needs (a spawned worker
+    # would import the __main__ module of the caller, TensorFlow included)
+    code = 'import sys, json; from rspd.quantize import _serving_memory; print(json.dumps(_serving_memory(*sys.argv[1:])))'
+    package_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [package_dir, os.environ.get('PYTHONPATH')])))
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        images_path = os.path.join(tmp_dir, 'images.npy')
+        np.save(images_path, np.asarray(images))
+        output = subprocess.run([sys.executable, '-c', code, os.path.abspath(model_path), images_path, str(batch_size)],
+                                env=env, check=True, capture_output=True, text=True).stdout
+    before, peak = json.loads(output.splitlines()[-1])
+    return {'serving_rss_mb': peak, 'serving_rss_growth_mb': peak - before}
+
+def compare_models(model, tflite_path, X, y, batch_size=64):
+    '''
+    Compare the int8 TFLite export with the float Keras model on the same images
+
+    Input:
+        model: Trained Keras model
+        tflite_path: TFLite file written by quantize_model
+        X: uint8 images to score
+        y: labels of the images
+        batch_size: number of images per call, for both models
+
+    returns: Dictionary of the throughput, latency per batch, model size (float weights in
+             memory, TFLite file), memory of serving the model (see serving_memory),
+             accuracy and AUC of both models, the AUC drift and the largest score
+             difference between them
+    '''
+    from .evaluate import evaluate_scores
+
+    float_weights = sum(w.nbytes for w in model.get_weights())
+    quantized = TFLiteModel(tflite_path, batch_size=batch_size)
+
+    results = {}
+    for name, predict in (('float', lambda images: model.predict(normalise_batch(images), batch_size=batch_size,
+                                                                 verbose=0).reshape(-1)),
+                          ('int8', quantized.predict)):
+        predict(np.asarray(X[:batch_size]))                       # Warm up
+        start = time.perf_counter()
+        scores = predict(np.asarray(X))
+        elapsed = time.perf_counter() - start
+        evaluation = evaluate_scores(y, scores)
+        results[name] = {'tiles_per_sec': len(X) / elapsed,
+                         'latency_ms_per_batch': 1000 * elapsed / int(np.ceil(len(X) / batch_size)),
+                         'accuracy': evaluation['accuracy'],
+                         'auc': evaluation['auc'],
+                         'scores': scores}
+    results['float']['model_bytes'] = float_weights
+    results['int8']['model_bytes'] = os.path.getsize(tflite_path)
+
+    # the weights leave out the runtime, the interpreter arena and the activations, measure a serving process instead
+    sample = np.asarray(X[:4 * batch_size])
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        float_path = os.path.join(tmp_dir, 'model.keras')
+        model.save(float_path)
+        results['float'].update(serving_memory(float_path, sample, batch_size))
+    results['int8'].update(serving_memory(tflite_path, sample, batch_size))
+    results['max_score_difference'] = float(np.abs(results['float'].pop('scores') - results['int8'].pop('scores')).max())
+    results['auc_drift'] = results['int8']['auc'] - results['float']['auc']
+    return results
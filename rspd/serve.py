@@ -0,0 +1,287 @@
+'''Local scoring server for a saved CNN model, with dynamic micro-batching'''
+import io
+import json
+import time
+import queue
+import threading
+import urllib.request
+from collections import deque
+from concurrent.futures import Future
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
+
+import numpy as np
+
+
+def load_scorer(model_path, max_batch=64, num_threads=None):
+    '''
+    model_path: Saved Keras model (.keras / .h5) or TFLite model written by quantize_model (.tflite)
+    max_batch: Largest batch the scorer is called with
+    num_threads: Number of TFLite interpreter threads, None for the default
+    returns: Function scoring a batch of uint8 images of shape (N, 101, 101, 3) into float32 scores of shape (N, )
+    '''
+    if model_path.endswith('.tflite'):
+        from .quantize import TFLiteModel
+        return TFLiteModel(model_path, batch_size=max_batch, num_threads=num_threads).predict
+
+    import keras
+    from .data import normalise_batch
+    model = keras.models.load_model(model_path)
+    return lambda images: np.asarray(model.predict_on_batch(normalise_batch(images)), dtype=np.float32).reshape(-1)
+
+class _Request:
+    '''
+    Images of one client request waiting to be scored
+    '''
+
+    def __init__(self, images):
+        self.images = images
+        self.arrival = time.perf_counter()
+        self.future = Future()
+
+class MicroBatcher:
+    '''
+    Coalesces concurrent scoring requests into micro-batches
+
+    Input:
+        scorer: function scoring a batch of uint8 images, e.g. from load_scorer
+        max_batch: maximum number of images per micro-batch
+        max_latency_ms: longest time the first request of a batch waits for more requests
+        window: number of recent requests the latency percentiles are computed over
+
+    A single thread owns the model. It takes the oldest request and keeps adding waiting
+    requests until the batch is full or the deadline of the first one is reached, scores
+    the batch in one call and hands every request its own scores.
+    '''
+
+    def __init__(self, scorer, max_batch=64, max_latency_ms=5.0, window=10000):
+        self.scorer = scorer
+        self.max_batch = max_batch
+        self.max_latency = max_latency_ms / 1000
+        self.queue = queue.Queue()
+        self.latencies = deque(maxlen=window)
+        self.queue_depths = deque(maxlen=window)
+        self.counts = {'requests': 0, 'tiles': 0, 'batches': 0}
+        self.lock = threading.Lock()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def warm_up(self, tile_shape=(101, 101, 3)):
+        '''
+        Score a batch of every power-of-two size up to max_batch, so the first requests do not
+        pay for graph building and allocations
+        '''
+        n = 1
+        while True:
+            self.scorer(np.zeros((min(n, self.max_batch), ) + tuple(tile_shape), dtype=np.uint8))
+            if n >= self.max_batch:
+                break
+            n *= 2
+
+    def submit(self, images):
+        '''
+        images: uint8 images of shape (N, 101, 101, 3)
+        returns: Future of the float32 scores of the images
+        '''
+        request = _Request(images)
+        self.queue.put(request)
+        return request.future
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+
+    def _run(self):
+        carry = None                                              # Request that did not fit in the previous batch
+        while True:
+            first = carry if carry is not None else self.queue.get()
+            carry = None
+            if first is None:
+                return
+            self.queue_depths.append(self.queue.qsize())
+            batch, size = [first], len(first.images)
+            deadline = first.arrival + self.max_latency
+            stop = False
+            while size < self.max_batch:
+                try:
+                    request = self.queue.get(timeout=max(0.0, deadline - time.perf_counter()))
+                except queue.Empty:
+                    break
+                if request is None:
+                    stop = True
+                    break
+                if size + len(request.images) > self.max_batch:
+                    carry = request
+                    break
+                batch.append(request)
+                size += len(request.images)
+            self._score(batch)
+            if stop:
+                return
+
+    def _score(self, batch):
+        try:
+            images = batch[0].images if len(batch) == 1 else np.concatenate([r.images for r in batch])
+            scores = self.scorer(images)
+        except Exception as error:
+            for request in batch:
+                request.future.set_exception(error)
+            return
+        done = time.perf_counter()
+        ends = np.cumsum([len(r.images) for r in batch])
+        for request, end in zip(batch, ends):
+            request.future.set_result(scores[end - len(request.images):end])
+        with self.lock:
+            self.latencies.extend(done - r.arrival for r in batch)
+            self.counts['requests'] += len(batch)
+            self.counts['tiles'] += len(images)
+            self.counts['batches'] += 1
+
+    def metrics(self):
+        '''
+        returns: Dictionary of the request counts, mean batch size, p50/p99 latency of the recent
+                 requests in ms and the current, mean and maximum queue depth
+        '''
+        with self.lock:
+            latencies = np.array(self.latencies) * 1000
+            depths = np.array(self.queue_depths)
+            counts = dict(self.counts)
+        metrics = dict(counts)
+        metrics['mean_batch_size'] = counts['tiles'] / counts['batches'] if counts['batches'] else 0.0
+        metrics['latency_ms_p50'] = float(np.percentile(latencies, 50)) if len(latencies) else None
+        metrics['latency_ms_p99'] = float(np.percentile(latencies, 99)) if len(latencies) else None
+        metrics['queue_depth'] = self.queue.qsize()
+        metrics['queue_depth_mean'] = float(depths.mean()) if len(depths) else 0.0
+        metrics['queue_depth_max'] = int(depths.max()) if len(depths) else 0
+        return metrics
+
+def _make_handler(batcher, tile_shape=(101, 101, 3)):
+    '''
+    Request handler class of the HTTP server, every request is checked before it joins a
+    micro-batch so a malformed one never fails the requests batched with it
+
+    POST /predict  body: np.save of uint8 images, one (101, 101, 3) tile or a (N, 101, 101, 3) batch
+                   returns: {"scores": [...]}
+    GET /metrics   returns: MicroBatcher.metrics()
+    GET /health    returns: {"status": "ok"}
+    '''
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'                             # Keep-alive, clients reuse their connection
+
+        def _reply(self, status, body):
+            data = json.dumps(body).encode()
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self):
+            if self.path == '/metrics':
+                self._reply(200, batcher.metrics())
+            elif self.path == '/health':
+                self._reply(200, {'status': 'ok'})
+            else:
+                self._reply(404, {'error': 'not found'})
+
+        def do_POST(self):
+            if self.path != '/predict':
+                self._reply(404, {'error': 'not found'})
+                return
+            body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            if not body:
+                self._reply(400, {'error': 'empty body, expected a .npy array'})
+                return
+            try:
+                images = np.load(io.BytesIO(body), allow_pickle=False)
+            except (ValueError, EOFError) as error:                # EOFError: truncated .npy header
+                self._reply(400, {'error': 'body is not a .npy array: {}'.format(error)})
+                return
+            if images.ndim == 3:
+                images = images[None]
+            if images.ndim != 4 or images.shape[1:] != tuple(tile_shape) or not len(images) \
+                    or images.dtype != np.uint8:
+                shape = ', '.join(str(size) for size in tile_shape)
+                self._reply(400, {'error': 'expected uint8 images of shape (N, {0}) or ({0}), got {1} {2}'.format(
+                    shape, images.dtype, images.shape)})
+                return
+            try:
+                scores = batcher.submit(images).result()
+            except Exception as error:
+                self._reply(500, {'error': str(error)})
+                return
+            self._reply(200, {'scores': scores.tolist()})
+
+        def log_message(self, format, *args):
+            pass                                                  # One line per request would dominate the cost
+
+    return Handler
+
+def serve(model_path, host='127.0.0.1', port=8500, max_batch=64, max_latency_ms=5.0, num_threads=None):
+    '''
+    Load a saved model once, warm it up and serve it over HTTP until interrupted
+
+    Input:
+        model_path: Saved Keras model or TFLite model
+        host: Interface to listen on, local only by default
+        port: Port to listen on
+        max_batch: maximum number of images per micro-batch
+        max_latency_ms: longest time a request waits for others to share its batch
+        num_threads: Number of TFLite interpreter threads, None for the default
+    '''
+    batcher = MicroBatcher(load_scorer(model_path, max_batch=max_batch, num_threads=num_threads), max_batch=max_batch,
+                           max_latency_ms=max_latency_ms)
+    batcher.warm_up()
+    server = ThreadingHTTPServer((host, port), _make_handler(batcher))
+    print('Serving {} on http://{}:{}'.format(model_path, host, port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        batcher.close()
+
+def benchmark(url='http://127.0.0.1:8500', concurrency=16, num_requests=2000, tiles_per_request=1,
+              tile_shape=(101, 101, 3), random_seed=1):
+    '''
+    Load generator for a running server
+
+    Input:
+        url: Address of the server
+        concurrency: number of clients sending requests at the same time
+        num_requests: total number of requests
+        tiles_per_request: number of images in every request
+        tile_shape: shape of one image
+        random_seed: seed of the random images
+
+    returns: Dictionary of the client-side throughput and p50/p99 latency, and the server metrics
+    '''
+    images = np.random.default_rng(random_seed).integers(0, 256, (tiles_per_request, ) + tuple(tile_shape),
+                                                         dtype=np.uint8)
+    buffer = io.BytesIO()
+    np.save(buffer, images)
+    body = buffer.getvalue()
+
+    def send(_):
+        request = urllib.request.Request(url + '/predict', data=body,
+                                         headers={'Content-Type': 'application/octet-stream'})
+        start = time.perf_counter()
+        with urllib.request.urlopen(request) as response:
+            response.read()
+        return time.perf_counter() - start
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        latencies = np.array(list(pool.map(send, range(num_requests)))) * 1000
+    elapsed = time.perf_counter() - start
+
+    with urllib.request.urlopen(url + '/metrics') as response:
+        server_metrics = json.loads(response.read())
+    return {'requests_per_sec': num_requests / elapsed,
+            'tiles_per_sec': num_requests * tiles_per_request / elapsed,
+            'latency_ms_p50': float(np.percentile(latencies, 50)),
+            'latency_ms_p99': float(np.percentile(latencies, 99)),
+            'server': server_metrics}
@@ -0,0 +1,242 @@
+'''Per-stage timing, throughput and memory of loading, training and prediction
+
+The stages (reading the csv, decoding the tiles, reading batches into the input pipeline,
+the input pipeline as a whole, every fold, every epoch and predicting) are instrumented
+with stage(), which does nothing unless a trace is being recorded:
+
+    with tracing('trace.json', chrome_path='trace.chrome.json'):
+        cv_performance_assessment(X, y, num_folds, build_model)
+
+The JSON trace holds every event and a summary per stage, including whether the input
+pipeline or the model is the bottleneck; the Chrome trace opens in chrome://tracing or
+Perfetto. TensorFlow's own profiler can be run alongside for the cost of every layer.
+'''
+import os
+import json
+import time
+import threading
+from contextlib import contextmanager
+
+_tracer = None                                                  # Tracer recording the stages, None when not tracing
+
+# the input pipeline alone must be this many times faster than training for it never to stall the model
+INPUT_HEADROOM = 1.5
+
+
+def _rss_mb():
+    '''
+    returns: Current resident memory of this process, in MB
+    '''
+    from .data import rss_mb                                    # rspd.data imports this module
+    return rss_mb()
+
+def _peak_rss_mb():
+    '''
+    returns: Peak resident memory of this process so far, in MB
+    '''
+    from .data import peak_rss_mb
+    return peak_rss_mb()
+
+class Tracer:
+    '''
+    Events of the stages run while tracing, from any thread or process
+    '''
+
+    def __init__(self, tf_profile_dir=None):
+        self.events = []
+        self.lock = threading.Lock()
+        self.tf_profile_dir = tf_profile_dir                    # Where TensorFlow's profiler writes, None when not run
+
+    def record(self, name, start, duration, items=None, peak_mb=None, **args):
+        '''
+        Input:
+            name: stage name
+            start: wall clock start of the stage, time.time()
+            duration: seconds the stage took
+            items: number of items (tiles, steps) the stage processed, for its throughput
+            peak_mb: peak resident memory of the process when the stage started, for how much
+                     the stage raised it ('peak_growth_mb'); None when not measured
+            args: anything else describing the stage, e.g. the fold number
+        '''
+        event = {'name': name, 'start': start, 'duration': duration, 'rss_mb': _rss_mb(),
+                 'pid': os.getpid(), 'tid': threading.get_ident()}
+        if peak_mb is not None:
+            event['peak_growth_mb'] = max(0.0, _peak_rss_mb() - peak_mb)
+        if items is not None:
+            event['items'] = items
+            event['items_per_sec'] = items / max(duration, 1e-9)
+        if args:
+            event['args'] = args
+        with self.lock:
+            self.events.append(event)
+
+    def extend(self, events):
+        '''
+        Add the events recorded by another tracer, e.g. in a cross validation worker
+        '''
+        with self.lock:
+            self.events.extend(events)
+
+    def summary(self):
+        '''
+        returns: Dictionary of the number of events, total and mean seconds, items, items/sec,
+                 the largest resident memory at the end of an event ('rss_mb_at_end') and the
+                 largest rise of the peak memory of the process during an event
+                 ('peak_growth_mb', None when not measured) of every stage, the
+                 'input_headroom' (tiles/sec of the input pipeline alone over tiles/sec of
+                 training) and the 'bottleneck': 'input' when the headroom is below
+                 INPUT_HEADROOM, else 'compute' (None when either was not traced)
+
+        A spike freed before the stage ends is missed by rss_mb_at_end but raises
+        peak_growth_mb, unless the process had already peaked higher in an earlier stage.
+        '''
+        stages = {}
+        for event in self.events:
+            stage = stages.setdefault(event['name'], {'count': 0, 'total_sec': 0.0, 'items': 0, 'rss_mb_at_end': 0.0,
+                                                      'peak_growth_mb': None})
+            stage['count'] += 1
+            stage['total_sec'] += event['duration']
+            stage['items'] += event.get('items', 0)
+            stage['rss_mb_at_end'] = max(stage['rss_mb_at_end'], event['rss_mb'])
+            if 'peak_growth_mb' in event:
+                stage['peak_growth_mb'] = max(stage['peak_growth_mb'] or 0.0, event['peak_growth_mb'])
+        for stage in stages.values():
+            stage['mean_sec'] = stage['total_sec'] / stage['count']
+            stage['items_per_sec'] = stage['items'] / max(stage['total_sec'], 1e-9) if stage['items'] else None
+
+        bottleneck, headroom = None, None
+        if stages.get('input_pipeline', {}).get('items') and stages.get('epoch', {}).get('items'):
+            headroom = stages['input_pipeline']['items_per_sec'] / stages['epoch']['items_per_sec']
+            bottleneck = 'input' if headroom < INPUT_HEADROOM else 'compute'
+        return {'stages': stages, 'input_headroom': headroom, 'bottleneck': bottleneck}
+
+    def save(self, path):
+        '''
+        Save the events and the summary as JSON
+        '''
+        with open(path, 'w') as f:
+            json.dump({'events': self.events, 'summary': self.summary()}, f, indent=2)
+
+    def save_chrome_trace(self, path):
+        '''
+        Save the events in the Chrome trace event format, one track per process and thread
+        '''
+        events = [{'name': event['name'], 'ph': 'X', 'ts': event['start'] * 1e6, 'dur': event['duration'] * 1e6,
+                   'pid': event['pid'], 'tid': event['tid'],
+                   'args': dict(event.get('args', {}), rss_mb=round(event['rss_mb'], 1),
+                                **({'peak_growth_mb': round(event['peak_growth_mb'], 1)}
+                                   if 'peak_growth_mb' in event else {}),
+                                **({'items': event['items'], 'items_per_sec': event['items_per_sec']}
+                                   if 'items' in event else {}))}
+                  for event in self.events]
+        with open(path, 'w') as f:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+
+def active():
+    '''
+    returns: True while a trace is being recorded
+    '''
+    return _tracer is not None
+
+def tf_profile_dir():
+    '''
+    returns: Directory TensorFlow's profiler writes to, None when it is not running. Worker
+             processes are not profiled with the parent, they run their own profiler into a
+             subdirectory of it
+    '''
+    return None if _tracer is None else _tracer.tf_profile_dir
+
+@contextmanager
+def stage(name, items=None, **args):
+    '''
+    Time the code in the with block as one event of the stage, when tracing
+    '''
+    if _tracer is None:
+        yield
+        return
+    start, begin, peak_mb = time.time(), time.perf_counter(), _peak_rss_mb()
+    try:
+        yield
+    finally:
+        _tracer.record(name, start, time.perf_counter() - begin, items, peak_mb, **args)
+
+def record(name, start, duration, items=None, peak_mb=None, **args):
+    '''
+    Record an event timed by the caller, when tracing
+    '''
+    if _tracer is not None:
+        _tracer.record(name, start, duration, items, peak_mb, **args)
+
+def merge(events):
+    '''
+    Add the events recorded in another process, when tracing
+    '''
+    if _tracer is not None:
+        _tracer.extend(events)
+
+def epoch_callback(num_tiles, **args):
+    '''
+    num_tiles: number of training tiles in one epoch
+    args: anything else describing the training, e.g. the fold
+    returns: Keras callback recording every epoch with its tiles/sec and steps/sec
+    '''
+    import keras
+
+    class EpochTrace(keras.callbacks.Callback):
+        def on_epoch_begin(self, epoch, logs=None):
+            self.steps = 0
+            self.start, self.begin, self.peak_mb = time.time(), time.perf_counter(), _peak_rss_mb()
+
+        def on_train_batch_end(self, batch, logs=None):
+            self.steps += 1
+
+        def on_epoch_end(self, epoch, logs=None):
+            duration = time.perf_counter() - self.begin
+            record('epoch', self.start, duration, num_tiles, self.peak_mb, epoch=epoch, steps=self.steps,
+                   steps_per_sec=self.steps / max(duration, 1e-9), **args)
+
+    return EpochTrace()
+
+def probe_input(dataset, num_batches=20):
+    '''
+    Time the input pipeline alone over a few batches (after a first warm up batch) and
+    record it as the 'input_pipeline' stage - reading, normalising and augmenting included
+    '''
+    batches = iter(dataset.take(num_batches + 1))
+    next(batches, None)
+    tiles = 0
+    start, begin, peak_mb = time.time(), time.perf_counter(), _peak_rss_mb()
+    for batch in batches:
+        tiles += len(batch[0])
+    if tiles:
+        record('input_pipeline', start, time.perf_counter() - begin, tiles, peak_mb)
+
+@contextmanager
+def tracing(path=None, chrome_path=None, tf_profile_dir=None):
+    '''
+    Record the stages run in the with block
+
+    Input:
+        path: file the JSON trace (events and summary) is saved to, None not to save it
+        chrome_path: file the Chrome trace is saved to, None not to save it
+        tf_profile_dir: directory TensorFlow's profiler writes to, for the cost of every
+                        layer and op in TensorBoard's profile tab; None not to run it
+
+    returns: The Tracer, holding the events once the with block ends
+    '''
+    global _tracer
+    previous, _tracer = _tracer, Tracer(tf_profile_dir)
+    tracer = _tracer
+    if tf_profile_dir is not None:
+        import tensorflow as tf
+        tf.profiler.experimental.start(tf_profile_dir)
+    try:
+        yield tracer
+    finally:
+        if tf_profile_dir is not None:
+            tf.profiler.experimental.stop()
+        _tracer = previous
+        if path is not None:
+            tracer.save(path)
+        if chrome_path is not None:
+            tracer.save_chrome_trace(chrome_path)
@@ -3,7 +3,6 @@
 
 '''Data Handling & Linear Algebra'''
 import numpy as np
-import pandas as pd
 
 '''Visualisation'''
 import matplotlib.pyplot as plt
@@ -12,19 +11,27 @@ from pylab import rcParams
 import seaborn as sns
 
 '''Data Analysis'''
-from sklearn.model_selection import StratifiedKFold
-from sklearn.metrics import roc_auc_score
-from sklearn.metrics import roc_curve
-from sklearn.metrics import confusion_matrix
+from rspd.evaluate import evaluate_scores
+from rspd.evaluate import threshold_sweep
+from rspd.evaluate import roc_auc
 
 '''Manipulating Data and Model Building'''
-from keras.layers import Conv2D
-from keras.layers import Dense
-from keras.layers import GlobalMaxPooling2D
-from keras.layers import MaxPooling2D
-from keras.layers import BatchNormalization
-from keras.layers import Add
-from keras.models import Sequential
+# the loading, model and cross-validation code lives in the rspd package next to this notebook,
+# which can also be used from the command line (python -m rspd --help)
+import os
+from rspd.data import load_data
+from rspd.data import list_tiles
+from rspd.data import peak_rss_mb
+from rspd.data import normalise_batch
+from rspd.model import build_model
+from rspd.model import to_fully_convolutional
+from rspd.cv import cv_performance_assessment
+from rspd.cv import train_model
+from rspd.inference import load_scene
+from rspd.inference import predict_scene
+from rspd.inference import window_views
+from rspd.quantize import quantize_model
+from rspd.quantize import compare_models
 
 """###Importing Google Drive for Dataset Access
 
@@ -32,12 +39,23 @@ from keras.models import Sequential
 - Upload this 'data' folder directly in your 'Main Drive'.
 """
 
-# from google.colab import drive
-from google.colab import drive
-drive.mount('/content/drive')
+# mount Google Drive when running on Colab, elsewhere set RSPD_DATA_DIR to your 'data' folder
+try:
+    from google.colab import drive
+    drive.mount('/content/drive')
+except ImportError:
+    pass
+
+DIR_DATA = os.environ.get('RSPD_DATA_DIR', "/content/drive/MyDrive/data")
+DIR_TRAIN_IMAGES = os.path.join(DIR_DATA, "training")
+DIR_TRAIN_LABELS = os.path.join(DIR_DATA, "labels_training.csv")
 
-DIR_TRAIN_IMAGES = "/content/drive/MyDrive/data/training/"
-DIR_TRAIN_LABELS = "/content/drive/MyDrive/data/labels_training.csv"
+# decoded tiles are cached on the local disk of the runtime, reading them back from Drive would be slow
+DIR_CACHE = os.environ.get('RSPD_CACHE_DIR', "/content/cache/")
+
+# the final model trained on all the images is saved here
+MODEL_PATH = os.path.join(DIR_DATA, "rspd_cnn.keras")
+TFLITE_PATH = os.path.join(DIR_DATA, "rspd_cnn_int8.tflite")
 
 # define dataset directories - th/content/drive/MyDrive/data/training/e below links won't work if you haven't placed 'data' folder in your 'Main Drive'
 # DIR_TRAIN_IMAGES = "D:\solar-panel-detection-master\data\\training\\"
@@ -49,31 +67,18 @@ DIR_TRAIN_LABELS = "/content/drive/MyDrive/data/labels_training.csv"
 
 """
 
+# pandas is only needed to show the labels, the evaluation below is plain numpy
+import pandas as pd
 pd.read_csv(DIR_TRAIN_LABELS).head()
 
-pwd
+os.getcwd()
 
 # LOADING DATA AND PREPROCESSING
 
-def load_data(dir_data, dir_labels):
-    '''
-    dir_data: Data directory
-    dir_labels: Respective csv file containing ids and labels
-    returns: Array of all the image arrays and its respective labels
-    '''
-    labels_pd = pd.read_csv(dir_labels)                         # Read the csv file with labels and ids as we saw above
-    ids = labels_pd.id.values                                   # Extracting ids from the csv file
-    data = []                                                   # Initiating the empty list to store each image as numpy array
-    for identifier in ids:                                      # Looping into the desired folder
-        fname = dir_data + identifier.astype(str) + '.tif'      # Generating the file name
-        image = mpl.image.imread(fname)                         # Reading image as numpy array using matplotlib
-        data.append(image)                                      # Appending this array into the empty list and repeat the above cycle
-    data = np.array(data)                                       # Now, convert the data list into data array
-    labels = labels_pd.label.values                             # Extract labels from the csv file
-    return data, labels                                                # Return the array of data and respective labels
-
-# load train data - time consuming code cell
-X, y = load_data(DIR_TRAIN_IMAGES, DIR_TRAIN_LABELS)
+print('Peak RSS before loading: {:.0f} MB'.format(peak_rss_mb()))
+
+# load train data - only the first run decodes the images, later runs read the cache
+X, y = load_data(DIR_TRAIN_IMAGES, DIR_TRAIN_LABELS, cache_dir=DIR_CACHE, timing=True)
 
 # import cv2
 
@@ -111,146 +116,20 @@ print('Distribution of y', np.bincount(y))
 """
 
 # scale pixel values between 0 and 1
-X = X / 255.0
+# X stays uint8 (8x smaller than float64), every batch is scaled to float32 inside the input pipeline
+# to stream tiles larger than RAM without building the cache, decode them lazily from the image directory instead:
+# X, y = list_tiles(DIR_TRAIN_IMAGES, DIR_TRAIN_LABELS)
 
 """#Building the CNN Model<a name ="h5"></a>
 
 
 
-# define CNN
-def build_model():
-    '''
-    Returns a Keras CNN model
-    '''
+"""
 
-    # define image dimensions
-    IMAGE_HEIGHT = 101
-    IMAGE_WIDTH = 101
-    IMAGE_CHANNELS = 3
-
-    # define a straightforward sequential neural network
-    model = Sequential()
-
-    # layer-1
-    #filter is convolutional matrix which is applied across the image = 32 filters
-    #kernal size is 3x3 matrix(filter)
-    #relu positive kept as it is, negative is taken out
-    model.add(Conv2D(filters=32,
-                     kernel_size=3,
-                     activation='relu',
-                     input_shape=(IMAGE_HEIGHT,
-                                  IMAGE_WIDTH,
-                                  IMAGE_CHANNELS)))
-
-    #adding normalizing layer to improve the speed of training
-    model.add(BatchNormalization())
-
-    # As we move forword in the layers pattern gets more complex,
-    # to capture the maximum combinations in subsequent layers
-    # layer-2
-    model.add(Conv2D(filters=64,
-                     kernel_size=3,
-                     activation='relu'))
-    model.add(BatchNormalization())
-
-    # layer-3
-    model.add(Conv2D(filters=128,
-                     kernel_size=3,
-                     activation='relu'))
-    model.add(BatchNormalization())
-
-    # Pooling layer is to reduce dimentions of feature map by summerizing presence of features
-    # max-pool - sends only imp data to next layer - here 2x2 matrix
-    model.add(MaxPooling2D(pool_size=2))
-
-    # layer-4
-    model.add(Conv2D(filters=64,
-                     kernel_size=3,
-                     activation='relu'))
-    model.add(BatchNormalization())
-
-    # layer-5
-    model.add(Conv2D(filters=128,
-                     kernel_size=3,
-                     activation='relu'))
-    model.add(BatchNormalization())
-
-    # max-pool
-    model.add(MaxPooling2D(pool_size=2))
-
-    # layer-6
-    model.add(Conv2D(filters=64,
-                     kernel_size=3,
-                     activation='relu'))
-    model.add(BatchNormalization())
-
-    # layer-7
-    model.add(Conv2D(filters=128,
-                     kernel_size=3,
-                     activation='relu'))
-    model.add(BatchNormalization())
-
-    # gobal-max-pool- performs downsampling by computing the maximum of the height and width dimensions of the input
-    # using it as a substitute of Flatten before passing it to the final layer
-    model.add(GlobalMaxPooling2D())
-
-    # output layer
-    model.add(Dense(1, activation='sigmoid'))
-
-    # compile model
-    model.compile(optimizer='adam', loss='binary_crossentropy', metrics=['accuracy'])
-
-    return model
+# the model is defined by build_model() in rspd/model.py
 
 """##Checking the Performance of our CNN Model"""
 
-# cross-validate CNN model
-def cv_performance_assessment(X, y, num_folds, clf, random_seed=1):
-    '''
-    Cross validated performance assessment
-
-    Input:
-        X: training data
-        y: training labels
-        num_folds: number of folds for cross validation
-        clf: classifier to use
-
-    Divide the training data into k folds of training and validation data.
-    For each fold the classifier will be trained on the training data and
-    tested on the validation data. The classifier prediction scores are
-    aggregated and output.
-    '''
-
-    prediction_scores = np.empty(y.shape[0], dtype='object')
-
-    # establish the num_folds folds
-    kf = StratifiedKFold(n_splits=num_folds, shuffle=True, random_state=random_seed)
-
-    for train_index, val_index in kf.split(X, y):
-        # extract the training and validation data for this fold
-        X_train, X_val = X[train_index], X[val_index]
-        y_train = y[train_index]
-
-        # give more weight to minority class based on the target class distribution
-        class_weight = {0: 505/1500, 1: 995/1500}
-
-        # train the classifier
-        training = clf.fit(x=X_train,
-                           y=y_train,
-                           class_weight=class_weight,
-                           batch_size=32,
-                           epochs=10,
-                           shuffle=True,
-                           verbose=1)
-
-        # test the classifier on the validation data for this fold
-        y_val_pred_probs = clf.predict(X_val).reshape((-1, ))
-
-        # save the predictions for this fold
-        prediction_scores[val_index] = y_val_pred_probs
-
-    return prediction_scores
-
 # number of subsets of data, where k subsets are used as test set and other k-1 subsets are used for the training purpose
 num_folds = 3
 
@@ -263,22 +142,28 @@ cnn = build_model()
 # lets look at summary of the model
 cnn.summary()
 
-# generate the probabilities (y_pred_prob)
-cnn_y_hat_prob = cv_performance_assessment(X, y, num_folds, cnn, random_seed=random_seed)
+# generate the probabilities (y_pred_prob) - every fold trains a fresh build_model(), one after another here:
+# run as a script, the worker processes would re-run this whole file. To run the folds in parallel processes use
+#   python -m rspd cv --folds 3 --scores cv_scores.npy
+cnn_y_hat_prob = cv_performance_assessment(X, y, num_folds, build_model, random_seed=random_seed, n_jobs=1)
+
+print('Peak RSS after cross-validation: {:.0f} MB'.format(peak_rss_mb()))
 
 """Looking at the True Positives, False Negatives, False Positives & True Negatives -
 
 
 """
 
-df = pd.read_csv(DIR_TRAIN_LABELS)                                              # Create a data frame of labels
-df["predicted_class"] = [1 if pred >= 0.5 else 0 for pred in cnn_y_hat_prob]    # Add a column to it for predicted class
+# AUC, confusion matrix, precision/recall/F1 at every threshold and the rows of every error bucket, in one pass
+evaluation = evaluate_scores(y, cnn_y_hat_prob, threshold=0.5)
+print('AUC: {:.4f}, accuracy: {:.4f}'.format(evaluation['auc'], evaluation['accuracy']))
+print('Best F1 {f1:.4f} at the threshold {threshold:.3f}'.format(**evaluation['best_f1']))
 
-# Get the values for FN, FP, TP, TN
-fn = np.array(df[(df['label'] == 1) & (df['predicted_class'] == 0)]['id'])      # False Negative
-fp = np.array(df[(df['label'] == 0) & (df['predicted_class'] == 1)]['id'])      # False Positive
-tp = np.array(df[(df['label'] == 1) & (df['predicted_class'] == 1)]['id'])      # True Positive
-tn = np.array(df[(df['label'] == 0) & (df['predicted_class'] == 0)]['id'])      # True Negative
+# Get the rows of FN, FP, TP, TN
+fn = evaluation['buckets']['fn']                                                # False Negative
+fp = evaluation['buckets']['fp']                                                # False Positive
+tp = evaluation['buckets']['tp']                                                # True Positive
+tn = evaluation['buckets']['tn']                                                # True Negative
 
 # Visuals of TP, TN, FP, and FN
 def show_images(image_ids, num_images, title, color):
@@ -337,8 +222,9 @@ def plot_roc(y_true, y_pred_cnn):
     plt.figure(figsize=(8, 8))
 
     # ROC of CNN
-    fpr, tpr, _ = roc_curve(y_true, y_pred_cnn, pos_label=1)
-    auc = roc_auc_score(y_true, y_pred_cnn)
+    sweep = threshold_sweep(y_true, y_pred_cnn)
+    fpr, tpr = sweep['fpr'], sweep['tpr']
+    auc = roc_auc(sweep)
     legend_string = 'CNN Model - AUC = {:0.3f}'.format(auc)
     plt.plot(fpr, tpr, color='red', label=legend_string)
 
@@ -356,7 +242,7 @@ def plot_roc(y_true, y_pred_cnn):
     pass
 
 # plot ROC
-y_pred = [1 if pred >= 0.5 else 0 for pred in cnn_y_hat_prob]
+y_pred = (cnn_y_hat_prob >= 0.5).astype(np.float32)
 plot_roc(y,  cnn_y_hat_prob)
 plot_roc(y, y_pred)
 
@@ -365,13 +251,62 @@ plot_roc(y, y_pred)
 """
 
 plt.figure(figsize=(5,5))
-sns.heatmap(confusion_matrix(y, y_pred), annot = True, cbar = False, fmt='.0f')
+sns.heatmap(np.array(evaluation['confusion_matrix']), annot = True, cbar = False, fmt='.0f')
 plt.show()
 
+"""#Scoring Whole Scenes
+
+The CNN scores one 101 x 101 tile at a time. `predict_scene` slides it over a whole orthophoto and stitches the window scores into a probability heatmap.
+"""
+
+# train the final model on all the images and save it for scoring new images
+cnn = train_model(X, y, build_model, random_seed=random_seed)
+cnn.save(MODEL_PATH)
+
+# the fully-convolutional version of the model scores every 101 x 101 window of an image in a single forward pass
+fcn, downsampling = to_fully_convolutional(cnn)
+
+# check it against the per-tile predictions on a mosaic of 2 x 2 training images
+mosaic = np.concatenate([np.concatenate([X[0], X[1]], axis=1),
+                         np.concatenate([X[2], X[3]], axis=1)], axis=0)
+windows = window_views(mosaic, 101, downsampling)                               # Every window the score map covers
+rows, cols = windows.shape[:2]
+tile_scores = cnn.predict(normalise_batch(windows.reshape((-1, 101, 101, 3)))).reshape(rows, cols)
+score_map = fcn.predict(normalise_batch(mosaic[None]))[0, :rows, :cols, 0]
+np.testing.assert_allclose(score_map, tile_scores, atol=1e-5)
+print('Largest difference to the per-tile predictions:', np.abs(score_map - tile_scores).max())
+
+"""##Exporting for CPU Serving
+
+The BatchNorm layers are folded into the weights of the next layers and the model is quantised to int8 with TFLite, calibrated on a sample of the training images.
+"""
+
+calibration_index = np.sort(np.random.default_rng(random_seed).choice(len(X), 200, replace=False))
+quantize_model(cnn, X[calibration_index], TFLITE_PATH)
+
+# speed, size, serving memory and accuracy of the int8 model against the float model (the AUC drift is what matters here,
+# both are measured on the images the final model was trained on)
+export_report = compare_models(cnn, TFLITE_PATH, X, y)
+for name in ('float', 'int8'):
+    print(name, export_report[name])
+print('AUC drift: {:+.4f}, largest score difference: {:.4f}'.format(export_report['auc_drift'],
+                                                                   export_report['max_score_difference']))
+
+# to keep the model loaded and score tiles over HTTP, run in a terminal:
+#   python -m rspd serve /content/drive/MyDrive/data/rspd_cnn_int8.tflite --max-batch 64 --max-latency-ms 5
+#   python -m rspd serve-bench --concurrency 16 --requests 2000
+
+# score a whole orthophoto (0.3 m per pixel) - put the path of your scene here
+# scene = load_scene("/content/drive/MyDrive/data/scene.tif")
+# scores, heatmap = predict_scene(cnn, scene, stride=32, timing=True)
+# plt.imshow(heatmap, cmap='inferno')
+# plt.colorbar()
+# plt.show()
+
 """## Task for you <mark>(Your chance to earn a certificate on completion!)</mark><a name ="h7"></a>
 
-- Use data augmentation to increase the size of the training data and train the model again.
-- If you are familar with transfer learning do try to implement and see if you get even better results.
+- Use data augmentation to increase the size of the training data and train the model again. Passing `augment=True` to `cv_performance_assessment` or `train_model` flips, rotates, jitters and crops every training batch on the fly, without copying `X`.
+- If you are familar with transfer learning do try to implement and see if you get even better results. `build_model(backbone='mobilenet_v2', weights=...)` puts a frozen pretrained backbone under a small head, and `embed_tiles` caches its features once per tile, so `cv_performance_assessment(features, y, num_folds, partial(build_head, features.shape[1]), n_jobs=1)` only trains the head.
 - In either of the cases write your conclusion based on what you changed and how you try it.
 
 <b>Submit your solution notebook using [this](https://forms.gle/Yz4mm4Lq29zA1WhF9) form! All the Best!
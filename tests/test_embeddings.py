@@ -0,0 +1,46 @@
+'''Embedding store: tiles embedded once, changed tiles embedded again'''
+import numpy as np
+import pytest
+
+keras = pytest.importorskip('keras')
+
+from rspd import model
+from rspd.embeddings import embed_tiles
+
+
+@pytest.fixture
+def backbone(monkeypatch):
+    '''
+    Replace the backbone by the mean of every channel, counting the tiles it embeds
+    '''
+    embedded = []
+
+    class Means:
+        def predict(self, dataset, verbose=0):
+            features = np.concatenate([keras.ops.convert_to_numpy(batch).mean(axis=(1, 2)) for batch in dataset])
+            embedded.append(len(features))
+            return features
+
+    monkeypatch.setattr(model, 'build_backbone', lambda backbone, weights=None, input_shape=None: Means())
+    return embedded
+
+def _tiles(values):
+    return np.stack([np.full((101, 101, 3), value, dtype=np.uint8) for value in values])
+
+def test_only_new_and_changed_tiles_are_embedded(tmp_path, backbone):
+    store_dir = str(tmp_path)
+    X, ids = _tiles([10, 20, 30]), np.array([7, 3, 5])
+    features = embed_tiles(X, ids, 'mobilenet_v2', store_dir=store_dir)
+    np.testing.assert_allclose(features[:, 0], np.float32([10, 20, 30]) / 255, atol=1e-4)
+    assert backbone == [3]
+
+    np.testing.assert_array_equal(embed_tiles(X, ids, 'mobilenet_v2', store_dir=store_dir), features)
+    assert backbone == [3]                                          # All read from the store
+
+    X_changed, ids_more = _tiles([10, 99, 30, 40]), np.array([7, 3, 5, 1])   # Tile 3 replaced, tile 1 new
+    features = embed_tiles(X_changed, ids_more, 'mobilenet_v2', store_dir=store_dir)
+    np.testing.assert_allclose(features[:, 0], np.float32([10, 99, 30, 40]) / 255, atol=1e-4)
+    assert backbone == [3, 2]
+
+    embed_tiles(X_changed, ids_more, 'mobilenet_v2', store_dir=store_dir, refresh=True)
+    assert backbone == [3, 2, 4]
@@ -0,0 +1,76 @@
+'''Vectorised evaluation against straightforward per-threshold computations'''
+import numpy as np
+import pytest
+
+from rspd.evaluate import at_threshold
+from rspd.evaluate import error_buckets
+from rspd.evaluate import evaluate_scores
+from rspd.evaluate import roc_auc
+from rspd.evaluate import threshold_sweep
+
+
+def _scores(n=2000, random_seed=1):
+    '''
+    returns: Labels and float32 scores with many ties, rounded to 2 decimals
+    '''
+    rng = np.random.default_rng(random_seed)
+    y = (rng.random(n) < 1/3).astype(int)
+    scores = np.clip(rng.normal(0.3 + 0.4 * y, 0.2), 0, 1).round(2).astype(np.float32)
+    return y, scores
+
+def test_sweep_matches_counts_at_every_threshold():
+    y, scores = _scores()
+    sweep = threshold_sweep(y, scores)
+    assert np.all(np.diff(sweep['threshold']) < 0)
+    for row, threshold in enumerate(sweep['threshold']):
+        predicted = scores >= threshold
+        assert sweep['tp'][row] == np.sum(predicted & (y == 1))
+        assert sweep['fp'][row] == np.sum(predicted & (y == 0))
+        assert sweep['fn'][row] == np.sum(~predicted & (y == 1))
+        assert sweep['tn'][row] == np.sum(~predicted & (y == 0))
+
+def test_sort_keeps_negative_and_zero_scores_in_order():
+    y = np.array([0, 1, 0, 1, 0, 1])
+    scores = np.array([-2.5, -0.0, 0.0, 1e-30, -1e-30, 3.0], dtype=np.float32)    # -0.0 and 0.0 are one tie
+    sweep = threshold_sweep(y, scores)
+    np.testing.assert_array_equal(sweep['threshold'][1:], np.float32([3.0, 1e-30, 0.0, -1e-30, -2.5]))
+    np.testing.assert_array_equal(sweep['tp'], [0, 1, 2, 3, 3, 3])
+
+def test_auc_matches_sklearn():
+    metrics = pytest.importorskip('sklearn.metrics')
+    y, scores = _scores()
+    assert roc_auc(threshold_sweep(y, scores)) == pytest.approx(metrics.roc_auc_score(y, scores), abs=1e-12)
+
+def test_auc_of_a_perfect_and_a_reversed_ranking():
+    y = np.array([0, 0, 1, 1])
+    assert roc_auc(threshold_sweep(y, [0.1, 0.2, 0.8, 0.9])) == 1.0
+    assert roc_auc(threshold_sweep(y, [0.9, 0.8, 0.2, 0.1])) == 0.0
+
+def test_at_threshold_between_swept_scores():
+    y, scores = _scores()
+    row = at_threshold(threshold_sweep(y, scores), 0.505)           # No score is 0.505, the next above is 0.51
+    predicted = scores >= 0.505
+    assert row['threshold'] == pytest.approx(0.51)
+    assert row['tp'] == np.sum(predicted & (y == 1))
+    assert row['fp'] == np.sum(predicted & (y == 0))
+
+def test_error_buckets():
+    y, scores = _scores()
+    buckets = error_buckets(y, scores, threshold=0.5)
+    predicted = scores >= 0.5
+    np.testing.assert_array_equal(buckets['tn'], np.flatnonzero((y == 0) & ~predicted))
+    np.testing.assert_array_equal(buckets['fp'], np.flatnonzero((y == 0) & predicted))
+    np.testing.assert_array_equal(buckets['fn'], np.flatnonzero((y == 1) & ~predicted))
+    np.testing.assert_array_equal(buckets['tp'], np.flatnonzero((y == 1) & predicted))
+
+def test_evaluate_scores():
+    y, scores = _scores()
+    evaluation = evaluate_scores(y, scores, threshold=0.5)
+    (tn, fp), (fn, tp) = evaluation['confusion_matrix']
+    assert [tn, fp, fn, tp] == [len(evaluation['buckets'][name]) for name in ('tn', 'fp', 'fn', 'tp')]
+    assert evaluation['accuracy'] == pytest.approx(np.mean((scores >= 0.5) == y))
+    assert evaluation['best_f1']['f1'] == pytest.approx(np.nanmax(evaluation['sweep']['f1']))
+
+def test_mismatched_lengths_raise():
+    with pytest.raises(ValueError):
+        threshold_sweep([0, 1, 1], [0.2, 0.7])
@@ -0,0 +1,33 @@
+'''Scene scoring on the batched path, where the windows are scored one by one'''
+import numpy as np
+import pytest
+
+pytest.importorskip('keras')
+
+from rspd.data import normalise_batch
+from rspd.inference import predict_scene
+from rspd.inference import window_views
+from rspd.model import build_model
+
+
+def _scene(height=180, width=170, random_seed=1):
+    return np.random.default_rng(random_seed).integers(0, 256, size=(height, width, 3), dtype=np.uint8)
+
+def _window_scores(model, scene, stride):
+    '''
+    returns: Score of every window, each predicted on its own
+    '''
+    windows = window_views(scene, 101, stride)
+    rows, cols = windows.shape[:2]
+    return model.predict(normalise_batch(windows.reshape((-1, 101, 101, 3))), verbose=0).reshape(rows, cols)
+
+@pytest.mark.parametrize('backbone, stride', [(None, 30), ('mobilenet_v2', 30), ('mobilenet_v2', 32)])
+def test_batched_scores_match_per_window_predictions(backbone, stride):
+    model = build_model(backbone)                                   # Random weights, nothing is downloaded
+    scene = _scene()
+    scores, heatmap = predict_scene(model, scene, stride=stride, batch_size=4)   # A padded last batch
+    expected = _window_scores(model, scene, stride)
+    assert scores.shape == expected.shape == (3, 3)
+    np.testing.assert_allclose(scores, expected, atol=1e-5)
+    assert heatmap.shape == scene.shape[:2]
+    assert np.nanmin(heatmap) >= scores.min() - 1e-6 and np.nanmax(heatmap) <= scores.max() + 1e-6
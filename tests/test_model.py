@@ -0,0 +1,42 @@
+'''The fully-convolutional model scores every window as the per-tile model does'''
+import numpy as np
+import pytest
+
+pytest.importorskip('keras')
+
+from rspd.data import normalise_batch
+from rspd.inference import window_views
+from rspd.model import build_model
+from rspd.model import to_fully_convolutional
+
+
+def _randomise_batch_norm(model, rng):
+    '''
+    Give every BatchNorm layer random statistics, fresh ones would be the identity and hide folding errors
+    '''
+    for layer in model.layers:
+        if layer.__class__.__name__ == 'BatchNormalization':
+            gamma, beta, mean, variance = layer.get_weights()
+            layer.set_weights([rng.uniform(0.5, 1.5, gamma.shape).astype(np.float32),
+                               rng.normal(0, 0.1, beta.shape).astype(np.float32),
+                               rng.normal(0, 0.1, mean.shape).astype(np.float32),
+                               rng.uniform(0.5, 1.5, variance.shape).astype(np.float32)])
+
+def test_fully_convolutional_matches_per_tile_predictions():
+    rng = np.random.default_rng(1)
+    model = build_model()
+    _randomise_batch_norm(model, rng)
+    fcn, downsampling = to_fully_convolutional(model)
+    assert downsampling == 4
+
+    tiles = rng.integers(0, 256, size=(4, 101, 101, 3), dtype=np.uint8)
+    mosaic = np.concatenate([np.concatenate([tiles[0], tiles[1]], axis=1),
+                             np.concatenate([tiles[2], tiles[3]], axis=1)], axis=0)
+    windows = window_views(mosaic, 101, downsampling)               # Every window the score map covers
+    rows, cols = windows.shape[:2]
+
+    tile_scores = model.predict(normalise_batch(windows.reshape((-1, 101, 101, 3))), verbose=0).reshape(rows, cols)
+    score_map = fcn.predict(normalise_batch(mosaic[None]), verbose=0)[0, :, :, 0]
+    assert score_map.shape[0] >= rows and score_map.shape[1] >= cols
+    score_map = score_map[:rows, :cols]                             # The last positions may overhang the image edge
+    np.testing.assert_allclose(score_map, tile_scores, atol=1e-5)
@@ -0,0 +1,111 @@
+'''Prediction cache: hits, misses, changed tiles, duplicated tiles and eviction'''
+import os
+import time
+
+import numpy as np
+import pytest
+
+from rspd import serve
+from rspd.predict import PredictionCache
+from rspd.predict import model_fingerprint
+from rspd.predict import predict_tiles
+
+Image = pytest.importorskip('PIL.Image')
+
+
+def _write_tile(fname, value):
+    Image.fromarray(np.full((101, 101, 3), value, dtype=np.uint8)).save(fname)
+
+@pytest.fixture
+def tiles(tmp_path):
+    '''
+    returns: Five tile files, the last one holding the same image as the first
+    '''
+    fnames = [str(tmp_path / '{}.tif'.format(i)) for i in range(5)]
+    for fname, value in zip(fnames, [10, 20, 30, 40, 10]):
+        _write_tile(fname, value)
+    return fnames
+
+@pytest.fixture
+def scorer(monkeypatch):
+    '''
+    Replace the model by the mean pixel value over 255, counting the tiles it scores
+    '''
+    scored = []
+
+    def load_scorer(model_path, max_batch=64, num_threads=None):
+        def score(images):
+            scored.append(len(images))
+            return images.reshape(len(images), -1).mean(axis=1).astype(np.float32) / 255
+        return score
+
+    monkeypatch.setattr(serve, 'load_scorer', load_scorer)
+    return scored
+
+def _model(tmp_path, content=b'weights v1'):
+    path = tmp_path / 'model.tflite'
+    path.write_bytes(content)
+    return str(path)
+
+def test_cold_warm_and_changed_runs(tmp_path, tiles, scorer):
+    model = _model(tmp_path)
+    cache = PredictionCache(str(tmp_path / 'cache.db'))
+    expected = np.float32([10, 20, 30, 40, 10]) / 255
+
+    scores, stats = predict_tiles(model, tiles, cache=cache)
+    np.testing.assert_allclose(scores, expected, rtol=1e-6)
+    assert (stats['hits'], stats['misses'], stats['scored'], stats['deduplicated']) == (0, 5, 4, 1)
+    assert stats['hit_rate'] == 0
+    assert sum(scorer) == 4                                         # The duplicated tile is scored once
+
+    scores, stats = predict_tiles(model, tiles, cache=cache)
+    np.testing.assert_allclose(scores, expected, rtol=1e-6)
+    assert (stats['hits'], stats['misses'], stats['scored']) == (5, 0, 0)
+    assert sum(scorer) == 4                                         # Nothing scored, the model is not even loaded
+
+    _write_tile(tiles[1], 50)
+    os.utime(tiles[1], ns=(0, 0))                                   # Another mtime, whatever the file system resolution
+    scores, stats = predict_tiles(model, tiles, cache=cache)
+    assert scores[1] == pytest.approx(50 / 255)
+    assert (stats['hits'], stats['misses'], stats['scored']) == (4, 1, 1)
+    cache.close()
+
+def test_matches_uncached_scores(tmp_path, tiles, scorer):
+    model = _model(tmp_path)
+    uncached, _ = predict_tiles(model, tiles)
+    cache = PredictionCache(str(tmp_path / 'cache.db'))
+    predict_tiles(model, tiles, cache=cache)
+    cached, _ = predict_tiles(model, tiles, cache=cache)
+    np.testing.assert_array_equal(cached, uncached)
+    cache.close()
+
+def test_new_model_version_misses_and_old_versions_are_evicted(tmp_path, tiles, scorer):
+    cache = PredictionCache(str(tmp_path / 'cache.db'), keep_models=1)
+    predict_tiles(_model(tmp_path, b'weights v1'), tiles, cache=cache)
+    assert len(cache) == 4
+
+    _, stats = predict_tiles(_model(tmp_path, b'weights v2'), tiles, cache=cache)
+    assert stats['hits'] == 0
+    assert stats['evicted'] == 4                                    # The scores of v1 go, keep_models=1
+    assert len(cache) == 4
+    cache.close()
+
+def test_max_entries_keeps_the_most_recently_used(tmp_path, tiles, scorer):
+    cache = PredictionCache(str(tmp_path / 'cache.db'), max_entries=3)
+    model = _model(tmp_path)
+    for run in ([0, 1], [2], [0], [3]):                             # Tile 0 looked up again, tile 1 is then the oldest
+        predict_tiles(model, [tiles[i] for i in run], cache=cache)
+        time.sleep(0.01)                                            # Every run its own last_used
+    kept = {digest for digest, in cache.db.execute('SELECT digest FROM predictions')}
+    assert kept == set(cache.tile_digests([tiles[0], tiles[2], tiles[3]]))
+
+def test_fingerprint_ignores_the_keras_save_date(tmp_path):
+    import zipfile
+    fingerprints = []
+    for date in ('2024-01-01', '2024-06-01'):
+        path = str(tmp_path / 'model-{}.keras'.format(date))
+        with zipfile.ZipFile(path, 'w') as archive:
+            archive.writestr('metadata.json', '{"date_saved": "' + date + '"}')
+            archive.writestr('model.weights.h5', b'weights')
+        fingerprints.append(model_fingerprint(path))
+    assert fingerprints[0] == fingerprints[1]